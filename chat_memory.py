@@ -0,0 +1,76 @@
+import os
+from utils import estimate_tokens, get_fm
+
+
+# Token budget of the recent messages sent verbatim to the FM with each chat message
+CHAT_MEMORY_TOKENS = int(os.environ.get("CHAT_MEMORY_TOKENS", "1000"))
+# Number of most recent chat messages displayed (earlier messages are displayed on request)
+CHAT_DISPLAY_MESSAGES = int(os.environ.get("CHAT_DISPLAY_MESSAGES", "20"))
+CHAT_SUMMARY_WORDS = 150
+SUMMARY_TEMPLATE = """Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary. Skip the preamble. Keep the summary under {words} words.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{lines}
+
+New summary:"""
+
+
+class ChatMemory:
+    """
+    Memory of a conversation with an FM. All messages are kept for display, but only the most recent messages that fit
+    the token budget are sent to the FM verbatim. Once they exceed the budget, the oldest of them are folded into a
+    running summary (a batch at a time, down to half of the budget), so the prompt stays bounded however long the
+    conversation gets.
+    """
+
+    def __init__(self, modelid:str, budget:int = CHAT_MEMORY_TOKENS):
+        self.modelid = modelid
+        self.budget = budget
+        # (role, text) tuples, where role is "human" or "ai"
+        self.messages = []
+        self.summary = ""
+        # Number of messages folded into the summary, and the usage of the FM invocation of the latest summary
+        self.summarized = 0
+        self.summary_usage = None
+
+    def add(self, role:str, text:str):
+        """Add a message to the conversation"""
+        self.messages.append((role, text))
+
+    @staticmethod
+    def line(role:str, text:str) -> str:
+        """Transcript line of a message"""
+        return f"{'Human' if role == 'human' else 'AI'}: {text}"
+
+    def tokens(self, position:int) -> int:
+        """Estimated number of tokens of the message at a position"""
+        return estimate_tokens(self.modelid, self.line(*self.messages[position]))
+
+    def compact(self):
+        """Fold the oldest recent messages into the summary if the recent messages exceed the token budget"""
+        if sum(self.tokens(i) for i in range(self.summarized, len(self.messages))) <= self.budget:
+            return
+        # Keep the latest message, and as many messages before it as fit half of the budget
+        start = len(self.messages) - 1
+        kept = self.tokens(start)
+        while start > self.summarized and kept + self.tokens(start - 1) <= self.budget // 2:
+            start -= 1
+            kept += self.tokens(start)
+        if start == self.summarized:
+            return
+        lines = "\n".join(self.line(*message) for message in self.messages[self.summarized:start])
+        generation = get_fm(self.modelid).generate(
+            [SUMMARY_TEMPLATE.format(words=CHAT_SUMMARY_WORDS, summary=self.summary or "None", lines=lines)],
+            max_tokens=CHAT_SUMMARY_WORDS * 2).generations[0][0]
+        self.summary = generation.text.strip()
+        self.summary_usage = generation.generation_info
+        self.summarized = start
+
+    def history(self) -> str:
+        """Conversation history for the next prompt - the summary of the earlier messages and the recent messages"""
+        lines = [f"Summary of the earlier conversation: {self.summary}"] if self.summary else []
+        lines += [self.line(*message) for message in self.messages[self.summarized:]]
+        return "\n".join(lines)
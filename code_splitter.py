@@ -0,0 +1,132 @@
+import os
+import re
+
+
+# Maximum number of characters of source code per unit translated (so that each translation fits the FM's output)
+CODE_UNIT_CHARS = int(os.environ.get("CODE_UNIT_CHARS", "2000"))
+# Leading lines shared by all units (imports, includes, package declarations)
+HEADER_PATTERN = re.compile(r"^\s*(import\b|from\s+\S+\s+import\b|package\b|#\s*include\b|#\s*import\b|using\b|use\b|require\b|extern\s+crate\b|//|#|/\*|\*|--)")
+# Lines that continue the statement of the previous lines at the same level (rather than starting a new block)
+CONTINUATION_PATTERN = re.compile(r"^\s*(else\b|elif\b|except\b|finally\b|catch\b|\)|\]|\}|\.)")
+STRING_PATTERN = re.compile(r'"(\\.|[^"\\])*"|\'(\\.|[^\'\\])*\'|//.*$')
+
+
+def line_levels(lines:list) -> list:
+    """
+    Nesting level at the start of each line: the brace depth for languages with braces, otherwise the indentation
+    beyond the least indented line (e.g. Python, or COBOL's areas A and B). Blank lines have no level (None).
+    """
+    if any("{" in line for line in lines):
+        depth, levels = 0, []
+        for line in lines:
+            levels.append(depth if line.strip() else None)
+            code = STRING_PATTERN.sub("", line)
+            depth = max(depth + code.count("{") - code.count("}"), 0)
+        return levels
+    indents = [len(line) - len(line.lstrip()) for line in lines if line.strip()]
+    base = min(indents, default=0)
+    return [len(line) - len(line.lstrip()) - base if line.strip() else None for line in lines]
+
+
+def split_blocks(lines:list, levels:list, level:int) -> list:
+    """
+    Split lines into blocks (lists of line positions) at a nesting level: a block starts at a line at that level that
+    follows a blank line or the end of a nested body, such as the next function after the end of a function.
+    """
+    blocks, previous, blank = [], None, False
+    for i, line in enumerate(lines):
+        if levels[i] is None:
+            blank = True
+        elif levels[i] <= level and blocks and (blank or (previous is not None and previous > level)) \
+                and not CONTINUATION_PATTERN.match(line):
+            blocks.append([i])
+        elif blocks:
+            blocks[-1].append(i)
+        else:
+            blocks.append([i])
+        if levels[i] is not None:
+            previous, blank = levels[i], False
+        elif blocks:
+            blocks[-1].append(i)
+    return blocks
+
+
+def split_header(lines:list) -> int:
+    """Number of leading lines that form the shared header of the code"""
+    # COBOL: the identification, environment and data divisions
+    for i, line in enumerate(lines):
+        if re.match(r"^\s*PROCEDURE\s+DIVISION\b", line, re.IGNORECASE):
+            return i
+    count, in_block = 0, False
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if in_block:
+            # Multi-line imports, e.g. Go's import ( ... )
+            in_block = not stripped.startswith(")")
+        elif stripped and not HEADER_PATTERN.match(line):
+            break
+        elif stripped.endswith("("):
+            in_block = True
+        count = i + 1
+    return count
+
+
+def pack_units(lines:list, levels:list, positions:list, level:int, context:str, max_chars:int) -> list:
+    """Group the blocks of lines at a level into units of at most max_chars, splitting larger blocks at the next level"""
+    units, current = [], []
+
+    def flush():
+        if current and "".join(lines[i] for i in current).strip():
+            units.append({"code": "".join(lines[i] for i in current), "context": context})
+        current.clear()
+
+    block_levels = [levels[i] for i in positions]
+    for block in split_blocks([lines[i] for i in positions], block_levels, level):
+        block = [positions[i] for i in block]
+        size = sum(len(lines[i]) for i in block)
+        if size > max_chars:
+            flush()
+            units += split_container(lines, levels, block, level, context, max_chars)
+            continue
+        if current and sum(len(lines[i]) for i in current) + size > max_chars:
+            flush()
+        current.extend(block)
+    flush()
+    return units
+
+
+def split_container(lines:list, levels:list, block:list, level:int, context:str, max_chars:int) -> list:
+    """Split a block that is too large (e.g. a class) into its declaration, its members and its closing line"""
+    inner = [i for i in block if levels[i] is not None and levels[i] > level]
+    if not inner:
+        # A long flat block (e.g. a large statement) cannot be split syntactically
+        return [{"code": "".join(lines[i] for i in block), "context": context}]
+    opening = [i for i in block if i < inner[0]]
+    closing = [i for i in block if i > inner[-1]]
+    body = [i for i in block if inner[0] <= i <= inner[-1]]
+    declaration = "".join(lines[i] for i in opening).strip()
+    nested_context = f"{context}\n{declaration}".strip() if declaration else context
+    units = pack_units(lines, levels, body, min(levels[i] for i in inner), nested_context, max_chars)
+    if units:
+        # The declaration and the closing line are translated with the first and last members
+        units[0]["code"] = "".join(lines[i] for i in opening) + units[0]["code"]
+        units[-1]["code"] += "".join(lines[i] for i in closing)
+        units[0]["opens"] = bool(opening)
+        units[-1]["closes"] = bool(closing)
+    return units
+
+
+def split_code(code:str, max_chars:int = CODE_UNIT_CHARS) -> tuple:
+    """
+    Split source code into syntactic units (functions, classes, or their members for large classes, and COBOL
+    paragraphs) of at most max_chars where possible, in order. Returns the shared header (imports, or COBOL's
+    divisions before the procedure division) and the units, each with the declarations of the code enclosing it.
+    """
+    lines = code.splitlines(keepends=True)
+    header_lines = split_header(lines)
+    header = "".join(lines[:header_lines])
+    lines = lines[header_lines:]
+    if not "".join(lines).strip():
+        return "", [{"code": code, "context": ""}]
+    levels = line_levels(lines)
+    return header, pack_units(lines, levels, list(range(len(lines))), 0, "", max_chars)
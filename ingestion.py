@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import queue
+import shutil
+import sqlite3
+import threading
+import multiprocessing
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pypdf import PdfReader
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+
+# Maximum number of characters per chunk (changing it applies to documents ingested afterwards)
+INGEST_CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", "1000"))
+# Number of chunks embedded and indexed together
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "256"))
+# Number of parsed batches buffered ahead of embedding - parsing pauses when the buffer is full
+INGEST_WINDOW = int(os.environ.get("INGEST_WINDOW", "4"))
+# Number of processes parsing PDFs (1 parses in-process) and number of pages parsed per task
+PDF_PARSE_WORKERS = int(os.environ.get("PDF_PARSE_WORKERS", str(os.cpu_count() or 1)))
+PDF_PARSE_PAGES_PER_TASK = int(os.environ.get("PDF_PARSE_PAGES_PER_TASK", "8"))
+
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=INGEST_CHUNK_SIZE,
+    chunk_overlap=0,
+    separators=["\n", "\n\n", "(?<=\. )"]
+    )
+
+
+def pdf_page_count(path:str) -> int:
+    """Number of pages in a PDF"""
+    with open(path, mode='rb') as r:
+        return len(PdfReader(r).pages)
+
+
+# Process pool for PDF parsing (text extraction is CPU-bound), created on first use and replaced if a worker dies
+# (e.g. killed for running out of memory). Processes are spawned rather than forked, since the application is multi-threaded.
+pdf_parse_pool = None
+pdf_parse_pool_lock = threading.Lock()
+
+
+def get_pdf_parse_pool() -> ProcessPoolExecutor:
+    """Get the process pool for PDF parsing"""
+    global pdf_parse_pool
+    with pdf_parse_pool_lock:
+        if pdf_parse_pool is None:
+            pdf_parse_pool = ProcessPoolExecutor(max_workers=PDF_PARSE_WORKERS,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return pdf_parse_pool
+
+
+def reset_pdf_parse_pool(pool:ProcessPoolExecutor):
+    """Discard a broken process pool, so that the next parse creates a new one"""
+    global pdf_parse_pool
+    with pdf_parse_pool_lock:
+        if pdf_parse_pool is pool:
+            pdf_parse_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def split_page_range(path:str, start:int, end:int) -> list:
+    """Extract and split pages [start, end) of a PDF. Runs in a worker process and returns (page number, chunks) tuples."""
+    with open(path, mode='rb') as r:
+        reader = PdfReader(r)
+        return [(page_number, text_splitter.split_text(reader.pages[page_number].extract_text()))
+                for page_number in range(start, end)]
+
+
+def iter_pdf_chunks(page_counts:dict, stop:threading.Event = None):
+    """
+    Yield the number of pages parsed so far, the chunks (LangChain documents) of each page of the PDFs in page_counts
+    ({path: number of pages}) and the path of the PDF if it is the PDF's last page (otherwise None), in order. Page
+    ranges of PDF_PARSE_PAGES_PER_TASK pages of all the PDFs are parsed in the process pool, with at most two tasks per
+    worker in flight, so that both a large document and several small documents are parsed by all workers.
+    """
+    tasks = [(path, start, min(start + PDF_PARSE_PAGES_PER_TASK, count))
+             for path, count in page_counts.items()
+             for start in range(0, count, PDF_PARSE_PAGES_PER_TASK)]
+    if PDF_PARSE_WORKERS <= 1 or len(tasks) <= 1:
+        # Not worth the inter-process round trip (or starting the pool)
+        results = (split_page_range(*task) for task in tasks)
+    else:
+        results = iter_pool_results(get_pdf_parse_pool(), tasks, 2 * PDF_PARSE_WORKERS, stop)
+    pages = 0
+    # PDFs without pages have no tasks
+    for path, count in page_counts.items():
+        if count == 0:
+            yield pages, [], path
+    for (path, start, end), page_chunks in zip(tasks, results):
+        for page_number, chunks in page_chunks:
+            pages += 1
+            yield pages, [Document(page_content=chunk, metadata={"source": path, "page": page_number})
+                          for chunk in chunks], path if page_number == page_counts[path] - 1 else None
+
+
+def iter_pool_results(pool:ProcessPoolExecutor, tasks:list, max_in_flight:int, stop:threading.Event = None):
+    """
+    Yield the results of split_page_range for each task in order, keeping at most max_in_flight tasks submitted.
+    If a worker dies, the pool is replaced for later parses and BrokenProcessPool is raised.
+    """
+    pending = deque()
+    tasks = iter(tasks)
+    try:
+        while True:
+            while len(pending) < max_in_flight:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pending.append(pool.submit(split_page_range, *task))
+            if not pending or (stop is not None and stop.is_set()):
+                return
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        reset_pdf_parse_pool(pool)
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def parse_pdfs(page_counts:dict, batches:queue.Queue, stop:threading.Event):
+    """
+    Parse and split PDFs into batches of chunks, blocking while the queue of batches is full. Each batch is queued
+    with the number of pages parsed so far and the paths of the PDFs whose last page is in the batch.
+    """
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    try:
+        batch, finished = [], []
+        pages = 0
+        for pages, chunks, path in iter_pdf_chunks(page_counts, stop):
+            batch += chunks
+            if path is not None:
+                finished.append(path)
+            if len(batch) >= INGEST_BATCH_SIZE:
+                put((pages, batch, finished))
+                batch, finished = [], []
+            if stop.is_set():
+                return
+        put((pages, batch, finished))
+    except Exception as e:
+        put(e)
+    finally:
+        put(None)
+
+
+def ingest_pdfs(paths:list, vector_db, embeddings, on_progress=None, on_file_done=None) -> int:
+    """
+    Stream PDFs through a page -> chunk -> embed -> index pipeline. Parsing runs in the process pool (fed from a
+    background thread) and overlaps embedding, with at most INGEST_WINDOW batches in flight, so memory is bounded by the window instead of the corpus.
+    If on_progress is provided, it is called from the calling thread with the number of pages parsed, the total number
+    of pages and the number of chunks indexed so far. If on_file_done is provided, it is called from the calling thread
+    with the path, number of pages and number of chunks of each PDF once all its chunks have been indexed, in order.
+    Returns the number of chunks indexed.
+    """
+    page_counts = {str(path): pdf_page_count(path) for path in paths}
+    total_pages = sum(page_counts.values())
+    batches = queue.Queue(maxsize=INGEST_WINDOW)
+    stop = threading.Event()
+    parser = threading.Thread(target=parse_pdfs, args=(page_counts, batches, stop), daemon=True)
+    parser.start()
+    chunks = 0
+    file_chunks = Counter()
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            pages, batch, finished = item
+            if batch:
+                texts = [doc.page_content for doc in batch]
+                vectors = embeddings.embed_documents(texts)
+                vector_db.add(texts, vectors, [doc.metadata for doc in batch], maintain=False)
+                chunks += len(batch)
+                file_chunks.update(doc.metadata["source"] for doc in batch)
+            for path in finished:
+                if on_file_done is not None:
+                    on_file_done(path, page_counts[path], file_chunks.pop(path, 0))
+            if on_progress is not None:
+                on_progress(pages, total_pages, chunks)
+    finally:
+        stop.set()
+        vector_db.maintain()
+    return chunks
+
+
+class IngestionCancelled(Exception):
+    """Raised to stop an ingestion job that has been cancelled"""
+
+
+# Jobs that have not finished
+ACTIVE_JOB_STATUSES = ("queued", "running", "cancelling")
+
+
+class IngestionJobs:
+    """
+    Persistent queue of document ingestion jobs, processed in order by a background worker thread so that the page
+    stays interactive. Each job ingests the PDFs in its own upload directory through a single pipeline (so that the
+    pages of all its files are parsed in parallel), moving each file to out_dir once it has been indexed, so that a job
+    interrupted by a restart resumes with the files not yet indexed. A rebuild job re-indexes files already in out_dir
+    in place.
+    A single application process is assumed to process the jobs of an upload directory.
+    """
+
+    def __init__(self, upload_dir:str, out_dir:str, vector_db, embeddings):
+        self.upload_dir = str(upload_dir)
+        self.out_dir = str(out_dir)
+        self.vector_db = vector_db
+        self.embeddings = embeddings
+        self.lock = threading.Lock()
+        # Serialises claiming the next job with cancelling jobs
+        self.claim_lock = threading.Lock()
+        self.running_job_id = None
+        self.wakeup = threading.Event()
+        self.db = sqlite3.connect(os.path.join(self.upload_dir, "jobs.db"), check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, status TEXT, job_dir TEXT,
+                           files TEXT, files_done TEXT, total_pages INTEGER, pages_done INTEGER, chunks INTEGER,
+                           file_pages INTEGER, file_chunks INTEGER, error TEXT, created_at REAL, updated_at REAL)""")
+        # Resume jobs interrupted by a restart (pages_done and chunks count the files indexed, file_pages and
+        # file_chunks the progress through the file being indexed)
+        self.execute("UPDATE jobs SET status = 'queued', file_pages = 0, file_chunks = 0 WHERE status = 'running'")
+        for job in self.execute("SELECT * FROM jobs WHERE status = 'cancelling'"):
+            self.finish_cancel(job["id"])
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def execute(self, sql:str, params:tuple = ()) -> list:
+        """Run a statement against the job table"""
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def update(self, job_id:int, **fields):
+        """Update fields of a job"""
+        fields["updated_at"] = time.time()
+        self.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?", (*fields.values(), job_id))
+
+    def submit(self, job_dir:str, files:list) -> int:
+        """Queue a job to ingest files (names of PDFs in job_dir, a directory under the upload directory)"""
+        now = time.time()
+        with self.lock:
+            job_id = self.db.execute("""INSERT INTO jobs (status, job_dir, files, files_done, pages_done, chunks, file_pages, file_chunks,
+                                                          created_at, updated_at)
+                                        VALUES ('queued', ?, ?, '[]', 0, 0, 0, 0, ?, ?)""",
+                                     (str(job_dir), json.dumps(files), now, now)).lastrowid
+        self.wakeup.set()
+        return job_id
+
+    def submit_rebuild(self, files:list) -> int:
+        """Queue a job to re-index files (names of PDFs) already in the output directory, e.g. after the index is cleared"""
+        return self.submit(self.out_dir, files)
+
+    def rebuild(self, job:dict) -> bool:
+        """Whether a job re-indexes files in the output directory (which must be kept)"""
+        return job["job_dir"] == self.out_dir
+
+    def job(self, job_id:int) -> dict:
+        """Get a job"""
+        rows = self.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return dict(rows[0]) if rows else None
+
+    def jobs(self, limit:int = 5) -> list:
+        """Get the active jobs and the most recently finished jobs, newest first"""
+        rows = self.execute(f"""SELECT * FROM jobs WHERE status IN ({', '.join('?' * len(ACTIVE_JOB_STATUSES))})
+                                UNION SELECT * FROM (SELECT * FROM jobs WHERE status NOT IN ({', '.join('?' * len(ACTIVE_JOB_STATUSES))})
+                                                     ORDER BY id DESC LIMIT ?)
+                                ORDER BY id DESC""", (*ACTIVE_JOB_STATUSES, *ACTIVE_JOB_STATUSES, limit))
+        return [dict(row) for row in rows]
+
+    def active(self) -> bool:
+        """Whether any job has not finished"""
+        return bool(self.execute(f"SELECT 1 FROM jobs WHERE status IN ({', '.join('?' * len(ACTIVE_JOB_STATUSES))}) LIMIT 1",
+                                 ACTIVE_JOB_STATUSES))
+
+    def cancel(self, job_id:int):
+        """Cancel a job - a running job stops at the next batch of chunks and its partially indexed file is removed"""
+        with self.claim_lock:
+            with self.lock:
+                cancelling = self.db.execute("UPDATE jobs SET status = 'cancelling' WHERE id = ? AND status IN ('queued', 'running', 'failed')",
+                                             (job_id,)).rowcount
+            # The worker cancels the running job
+            if cancelling and job_id != self.running_job_id:
+                self.finish_cancel(job_id)
+
+    def retry(self, job_id:int):
+        """Queue a failed job again, resuming from the first file not yet indexed"""
+        self.execute("UPDATE jobs SET status = 'queued', error = NULL WHERE id = ? AND status = 'failed'", (job_id,))
+        self.wakeup.set()
+
+    def finish_cancel(self, job_id:int):
+        """
+        Mark a job cancelled (or a failed job discarded), and remove the files it has not indexed and the chunks
+        already indexed for them
+        """
+        job = self.job(job_id)
+        if not self.rebuild(job):
+            files_done = json.loads(job["files_done"])
+            for f in json.loads(job["files"]):
+                if f not in files_done:
+                    self.vector_db.delete_source(f)
+            shutil.rmtree(job["job_dir"], ignore_errors=True)
+        self.update(job_id, status="cancelled", file_pages=0, file_chunks=0)
+
+    def claim(self) -> dict:
+        """Mark the oldest queued job as running and return it"""
+        with self.claim_lock:
+            rows = self.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1")
+            if not rows:
+                self.running_job_id = None
+                return None
+            self.running_job_id = rows[0]["id"]
+            self.update(self.running_job_id, status="running")
+            return dict(rows[0])
+
+    def run(self):
+        """Process queued jobs until the application exits"""
+        while True:
+            job = self.claim()
+            if job is None:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+            self.process(job)
+
+    def process(self, job:dict):
+        """Ingest the files of a job that have not been indexed yet"""
+        job_id = job["id"]
+        files = json.loads(job["files"])
+        files_done = json.loads(job["files_done"])
+        pages_done, chunks_done = job["pages_done"], job["chunks"]
+        remaining = [f for f in files if f not in files_done]
+        # Pages and chunks of the files indexed by this run, which the pipeline's progress includes
+        run_pages = run_chunks = 0
+        try:
+            if job["total_pages"] is None:
+                self.update(job_id, total_pages=sum(pdf_page_count(os.path.join(job["job_dir"], f)) for f in files))
+
+            def on_file_done(path:str, pages:int, chunks:int):
+                nonlocal pages_done, chunks_done, run_pages, run_chunks
+                f = os.path.basename(path)
+                if not self.rebuild(job):
+                    os.replace(path, os.path.join(self.out_dir, f))
+                files_done.append(f)
+                pages_done += pages
+                chunks_done += chunks
+                run_pages += pages
+                run_chunks += chunks
+                self.update(job_id, files_done=json.dumps(files_done), pages_done=pages_done, chunks=chunks_done)
+
+            def on_progress(pages:int, total:int, chunks:int):
+                self.update(job_id, file_pages=pages - run_pages, file_chunks=chunks - run_chunks)
+                if self.job(job_id)["status"] == "cancelling":
+                    raise IngestionCancelled()
+
+            # Replace the chunks of documents uploaded again, or partially indexed before a restart
+            for f in remaining:
+                self.vector_db.delete_source(f)
+            ingest_pdfs([os.path.join(job["job_dir"], f) for f in remaining], self.vector_db, self.embeddings,
+                        on_progress=on_progress, on_file_done=on_file_done)
+            if not self.rebuild(job):
+                shutil.rmtree(job["job_dir"], ignore_errors=True)
+            self.update(job_id, status="done", file_pages=0, file_chunks=0)
+        except IngestionCancelled:
+            with self.claim_lock:
+                self.running_job_id = None
+                self.finish_cancel(job_id)
+        except Exception as e:
+            self.update(job_id, status="failed", error=str(e), file_pages=0, file_chunks=0)
+        finally:
+            with self.claim_lock:
+                self.running_job_id = None
+
+
+# Ingestion job queues are shared by all sessions
+ingestion_jobs = {}
+ingestion_jobs_lock = threading.Lock()
+
+
+def get_ingestion_jobs(upload_dir:str, out_dir:str, vector_db, embeddings) -> IngestionJobs:
+    """Get the ingestion job queue for an upload directory, starting its worker on first use"""
+    with ingestion_jobs_lock:
+        if str(upload_dir) not in ingestion_jobs:
+            ingestion_jobs[str(upload_dir)] = IngestionJobs(upload_dir, out_dir, vector_db, embeddings)
+        return ingestion_jobs[str(upload_dir)]
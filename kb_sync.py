@@ -0,0 +1,128 @@
+import io
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from utils import get_client, ClientError
+
+
+# Seconds between polls of a knowledge base ingestion job, doubling after each poll up to the maximum
+KB_SYNC_POLL_INITIAL = float(os.environ.get("KB_SYNC_POLL_INITIAL", "2"))
+KB_SYNC_POLL_MAX = float(os.environ.get("KB_SYNC_POLL_MAX", "30"))
+# Ingestion job statuses of a sync that has not finished
+ACTIVE_SYNC_STATUSES = ("STARTING", "IN_PROGRESS")
+# Labels of the ingestion job statistics displayed
+SYNC_STATISTICS = {
+    "numberOfDocumentsScanned": "Scanned",
+    "numberOfNewDocumentsIndexed": "New",
+    "numberOfModifiedDocumentsIndexed": "Modified",
+    "numberOfDocumentsDeleted": "Deleted",
+    "numberOfDocumentsFailed": "Failed",
+}
+
+# Number of files uploaded to the S3 bucket (data source) concurrently, and the multipart settings for each file
+S3_UPLOAD_MAX_CONCURRENCY = int(os.environ.get("S3_UPLOAD_MAX_CONCURRENCY", "8"))
+s3_transfer_config = TransferConfig(
+    multipart_threshold=int(os.environ.get("S3_MULTIPART_THRESHOLD_MB", "16")) * 1024 * 1024,
+    multipart_chunksize=int(os.environ.get("S3_MULTIPART_CHUNKSIZE_MB", "16")) * 1024 * 1024,
+    max_concurrency=int(os.environ.get("S3_MULTIPART_CONCURRENCY", "4")),
+    use_threads=True
+    )
+s3_upload_executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_MAX_CONCURRENCY, thread_name_prefix="s3-upload")
+
+# Knowledge base syncs, keyed by (knowledge base ID, data source ID), are tracked for all sessions
+kb_syncs = {}
+kb_syncs_lock = threading.Lock()
+
+
+def start_kb_sync(kb_id:str, ds_id:str) -> dict:
+    """Start syncing a knowledge base with a data source in the background, unless the pair is already syncing"""
+    with kb_syncs_lock:
+        sync = kb_syncs.get((kb_id, ds_id))
+        if sync is not None and sync["status"] in ACTIVE_SYNC_STATUSES:
+            return sync
+        sync = {"kb_id": kb_id, "ds_id": ds_id, "job_id": None, "status": "STARTING", "statistics": {},
+                "failure_reasons": [], "polls": 0, "started_at": time.time(), "finished_at": None}
+        kb_syncs[(kb_id, ds_id)] = sync
+    threading.Thread(target=run_kb_sync, args=(sync,), daemon=True).start()
+    return sync
+
+
+def run_kb_sync(sync:dict):
+    """Start an ingestion job for a sync and poll it with exponential backoff until it finishes"""
+    bedrock_agent = get_client('bedrock-agent')
+    try:
+        response = bedrock_agent.start_ingestion_job(knowledgeBaseId=sync["kb_id"], dataSourceId=sync["ds_id"])
+        sync["job_id"] = response["ingestionJob"]["ingestionJobId"]
+        delay = KB_SYNC_POLL_INITIAL
+        while True:
+            job = response["ingestionJob"]
+            sync["status"] = job["status"]
+            sync["statistics"] = job.get("statistics", {})
+            sync["failure_reasons"] = job.get("failureReasons", [])
+            if job["status"] not in ACTIVE_SYNC_STATUSES:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, KB_SYNC_POLL_MAX)
+            response = bedrock_agent.get_ingestion_job(knowledgeBaseId=sync["kb_id"], dataSourceId=sync["ds_id"],
+                                                       ingestionJobId=sync["job_id"])
+            sync["polls"] += 1
+    except ClientError as e:
+        sync["status"] = "FAILED"
+        sync["failure_reasons"] = [e.response["Error"]["Message"]]
+    except Exception as e:
+        # e.g. connection or credential errors, or an unexpected response
+        sync["status"] = "FAILED"
+        sync["failure_reasons"] = [f"{type(e).__name__}: {e}"]
+    finally:
+        # A sync never stays active once its thread ends, so the page stops polling it and it can be restarted
+        if sync["status"] in ACTIVE_SYNC_STATUSES:
+            sync["status"] = "FAILED"
+            sync["failure_reasons"] = sync["failure_reasons"] or ["The sync stopped unexpectedly"]
+        sync["finished_at"] = time.time()
+
+
+def list_kb_syncs() -> list:
+    """Get the tracked knowledge base syncs, most recently started first"""
+    with kb_syncs_lock:
+        return sorted((dict(sync) for sync in kb_syncs.values()), key=lambda sync: sync["started_at"], reverse=True)
+
+
+def dismiss_kb_sync(kb_id:str, ds_id:str):
+    """Stop displaying a finished knowledge base sync"""
+    with kb_syncs_lock:
+        sync = kb_syncs.get((kb_id, ds_id))
+        if sync is not None and sync["status"] not in ACTIVE_SYNC_STATUSES:
+            del kb_syncs[(kb_id, ds_id)]
+
+
+def upload_file_to_s3(doc, bucket:str) -> int:
+    """
+    Upload a file (an object with a name and getvalue(), such as a Streamlit uploaded file) to an S3 bucket, unless
+    the object already has the same content. Returns the number of bytes uploaded, or None if the file was skipped.
+    """
+    data = doc.getvalue()
+    sha256 = hashlib.sha256(data).hexdigest()
+    try:
+        head = get_client('s3').head_object(Bucket=bucket, Key=doc.name)
+        # The content hash is stored in the object's metadata (the ETag is the MD5 of single-part uploads only)
+        if head["Metadata"].get("sha256") == sha256 or head["ETag"].strip('"') == hashlib.md5(data).hexdigest():
+            return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+            raise
+    get_client('s3').upload_fileobj(io.BytesIO(data), bucket, doc.name, ExtraArgs={"Metadata": {"sha256": sha256}},
+                                    Config=s3_transfer_config)
+    return len(data)
+
+
+def upload_to_s3(docs:list, bucket:str) -> dict:
+    """Upload files to an S3 bucket concurrently, skipping unchanged files, and return the upload statistics"""
+    started_at = time.time()
+    sizes = list(s3_upload_executor.map(lambda doc: upload_file_to_s3(doc, bucket), docs))
+    seconds = time.time() - started_at
+    uploaded_bytes = sum(size for size in sizes if size is not None)
+    return {"uploaded": sum(1 for size in sizes if size is not None), "skipped": sizes.count(None),
+            "bytes": uploaded_bytes, "seconds": seconds, "mb_per_sec": uploaded_bytes / 1024 / 1024 / seconds if seconds else 0.0}
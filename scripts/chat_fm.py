@@ -1,9 +1,7 @@
 import streamlit as st
-from langchain.memory import ConversationBufferMemory
-from langchain.memory.chat_message_histories import StreamlitChatMessageHistory
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
 from utils import *
+from chat_memory import *
 
 
 # Get text-to-text FMs
@@ -12,25 +10,50 @@ t2t_fms = list_bedrock_fm_ids(["TEXT"], ["TEXT"], ["ON_DEMAND"])
 
 def fm_chat(modelid:str):
     """Start chat with specific FM"""
-    msgs = StreamlitChatMessageHistory(key=f"{modelid}_key")
-    memory = ConversationBufferMemory(memory_key="history", chat_memory=msgs)
-    if len(msgs.messages) == 0:
-       msgs.add_ai_message("How can I help you?")
+    if f"{modelid}_memory" not in st.session_state:
+        st.session_state[f"{modelid}_memory"] = ChatMemory(modelid)
+        st.session_state[f"{modelid}_memory"].add("ai", "How can I help you?")
+    memory = st.session_state[f"{modelid}_memory"]
     template = """You are an AI chatbot having a conversation with a human.
 
     {history}
     Human: {human_input}
     AI: """
     prompt = PromptTemplate(input_variables=["history", "human_input"], template=template)
-    fm = get_fm(modelid)
-    fm_chain = LLMChain(llm=fm, prompt=prompt, memory=memory)
-    for msg in msgs.messages:
-        st.chat_message(msg.type).write(msg.content)
+    # Display the most recent messages only, unless the earlier messages are requested
+    hidden = max(len(memory.messages) - CHAT_DISPLAY_MESSAGES, 0)
+    if hidden and not st.session_state.get(f"{modelid}_show_all_key"):
+        st.button(f"Show {hidden} earlier messages", key=f"{modelid}_show_earlier_key",
+                  on_click=lambda: st.session_state.update({f"{modelid}_show_all_key": True}))
+    else:
+        hidden = 0
+    for role, text in memory.messages[hidden:]:
+        st.chat_message(role).write(text)
     prompt_chat = st.chat_input(placeholder="Start a conversation!", key="prompt_key")
     if prompt_chat:
         st.chat_message("human").write(prompt_chat)
-        response = fm_chain.run(prompt_chat)
-        st.chat_message("ai").write(response)
+        reply = {"text": ""}
+
+        def on_text(text:str):
+            reply["text"] = text
+            response_shell.markdown(text + "▌")
+
+        try:
+            with st.chat_message("ai"):
+                # Stream the reply - a new message sent meanwhile stops this script run, which closes the stream
+                response_shell = st.empty()
+                response, usage = collect_fm_stream(ask_fm_stream(modelid, prompt.format(history=memory.history(), human_input=prompt_chat)),
+                                                    on_text=on_text)
+                response_shell.markdown(response)
+                st.markdown(token_summary(usage) + (f" ({memory.summarized} earlier messages summarized)" if memory.summarized else ""),
+                            unsafe_allow_html=True)
+        finally:
+            # Keep the message, and the reply received so far if it was cancelled
+            memory.add("human", prompt_chat)
+            if reply["text"]:
+                memory.add("ai", reply["text"])
+        # Summarize the oldest messages if the conversation has outgrown the token budget
+        memory.compact()
 
 
 def main():
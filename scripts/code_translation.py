@@ -1,5 +1,6 @@
 import streamlit as st
 from utils import *
+from code_splitter import *
 
 
 # Get text-to-text FMs
@@ -15,6 +16,42 @@ You will translate the code below to {tgt_lang} while following coding best prac
 </code>
 
 """
+# Construct prompt template for translating a unit (e.g. a function) of a larger program
+unit_prompt_template = """
+You are an expert software developer in {tgt_lang}. 
+You will translate a part of a larger program to {tgt_lang} while following coding best practices and accurate syntax.
+The other parts of the program are translated separately and concatenated with your translation in order, so translate only the code below. {position}
+Use the context only as a reference for the names it declares - do not translate it. Respond with the translated code only, in a single code block.
+<context>
+{context}
+</context>
+<code>
+{code}
+</code>
+
+"""
+# Number of units of a program translated concurrently
+CODE_TRANSLATION_CONCURRENCY = int(os.environ.get("CODE_TRANSLATION_CONCURRENCY", "4"))
+
+
+def unit_prompts(code:str, tgt_lang:str) -> list:
+    """Split code into syntactic units and construct the prompts to translate them, in order"""
+    header, units = split_code(code)
+    prompts = []
+    if header.strip():
+        prompts.append(unit_prompt_template.format(tgt_lang=tgt_lang, context="", code=header,
+                                                   position="This is the beginning of the program (its imports and shared declarations)."))
+    for unit in units:
+        position = ""
+        if unit["context"]:
+            position = "The code is part of the body of the last declaration in the context."
+            if unit.get("opens"):
+                position += " It begins with that declaration - translate the declaration without closing it."
+            if unit.get("closes"):
+                position += " It ends with the end of that declaration."
+        prompts.append(unit_prompt_template.format(tgt_lang=tgt_lang, context=f"{header}{unit['context']}".strip(),
+                                                   code=unit["code"], position=position))
+    return prompts
 
 
 def main():
@@ -57,18 +94,43 @@ def main():
             st.session_state.src_lang_code_key = ""
         if "tgt_code" not in st.session_state:
             tgt_code = ""          
+        translate = False
         if st.button("Translate", type="primary"):
             if len(st.session_state.src_lang_code_key) < 50:
                 with fm_prompt_validation.container():
                     st.error('Your question must contain at least 50 characters.', icon="🚨")
             else:
-                prompt = prompt_template.format(code=st.session_state.src_lang_code_key, tgt_lang=st.session_state.tgt_lang_key)
-                response, in_tokens, out_tokens = ask_fm(st.session_state.fm_key, prompt)
-                tgt_code = f"<div id='divshell'>{response}</div>"
+                if len(st.session_state.src_lang_code_key) > CODE_UNIT_CHARS:
+                    # Translate large programs unit by unit, concurrently
+                    prompts = unit_prompts(st.session_state.src_lang_code_key, st.session_state.tgt_lang_key)
+                else:
+                    prompts = [prompt_template.format(code=st.session_state.src_lang_code_key, tgt_lang=st.session_state.tgt_lang_key)]
+                translate = True
     with col2:
         src_lang_code = st.text_area("Enter code to be translated in the text area below:",key="src_lang_code_key")
     with col3:
-        st.markdown(tgt_code, unsafe_allow_html=True)
+        tgt_code_output = st.empty()
+        if translate:
+            # Render the translation of each unit incrementally, in order, as it is streamed from the FM
+            translations = [""] * len(prompts)
+            with tgt_code_output.container():
+                progress = st.empty()
+                unit_outputs = [st.empty() for _ in prompts]
+            done = 0
+            for key, event, payload in fan_out_fm_streams({i: (st.session_state.fm_key, prompt) for i, prompt in enumerate(prompts)},
+                                                          max_concurrency=CODE_TRANSLATION_CONCURRENCY):
+                if event == "error":
+                    translations[key] = f"Error: {payload}"
+                else:
+                    translations[key] = payload if event == "text" else payload["text"]
+                if event != "text":
+                    done += 1
+                    if len(prompts) > 1:
+                        progress.caption(f"Translated {done} of {len(prompts)} units")
+                unit_outputs[key].markdown(f"<div id='divshell'>{translations[key]}</div>", unsafe_allow_html=True)
+            response = "\n\n".join(translations)
+            tgt_code = f"<div id='divshell'>{response}</div>"
+        tgt_code_output.markdown(tgt_code, unsafe_allow_html=True)
 
 
 # Main  
@@ -24,6 +24,9 @@ def main():
     '''
     st.write(css, unsafe_allow_html=True)
     st.header("Foundation models hosted on Amazon Bedrock")
+    # The FM catalog is cached, so allow an explicit refresh from Bedrock
+    if st.button("Refresh"):
+        refresh_fm_catalog()
     # Generate the table of Bedrock FMs
     df, unique_providers, color_map = generate_bedrock_fm_table()
     # Selecting a provider to filter by
@@ -36,8 +39,11 @@ def main():
     # Apply the styling
     styled_df = filtered_df.style.apply(lambda x: colorize_rows(x, color_map), axis=1)
     st.markdown(f"<b>{len(filtered_df.index)}</b> foundation model variants from <b>{provider}</b>", unsafe_allow_html=True)
+    st.caption(f"Last refreshed from Amazon Bedrock: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(fm_catalog['fetched_at']))}")
     #st.markdown(html, unsafe_allow_html=True)
     st.dataframe(styled_df, hide_index=True, use_container_width=True)
+    with st.expander("Connection pool statistics"):
+        st.dataframe(pd.DataFrame(client_pool_stats()), hide_index=True, use_container_width=True)
 
 
 # Main  
@@ -42,11 +42,12 @@ def main():
                     st.error('Your question must contain at least 10 characters.', icon="🚨")
             else:
                 with fm_output.container():
-                    response, _in_tokens, _out_tokens = ask_fm(st.session_state.fm_key,st.session_state.fm_prompt_key)
-                    in_tokens = _in_tokens if _in_tokens is not None else "Not provided"
-                    out_tokens = _out_tokens if _out_tokens is not None else "Not provided"
-                    st.markdown(f"""<div id='divshell'>{response}</div>
-                    <b>Input Tokens:</b> {in_tokens} | <b>Output Tokens:</b> {out_tokens}""", unsafe_allow_html=True)
+                    response_shell = st.empty()
+                    # Render the response incrementally as it is streamed from the FM
+                    response, usage = collect_fm_stream(ask_fm_stream(st.session_state.fm_key,st.session_state.fm_prompt_key),
+                                                        on_text=lambda text: response_shell.markdown(f"<div id='divshell'>{text}</div>", unsafe_allow_html=True))
+                    response_shell.markdown(f"""<div id='divshell'>{response}</div>
+                    {token_summary(usage)}""", unsafe_allow_html=True)
 
 # Main  
 if __name__ == "__main__":
@@ -1,17 +1,20 @@
 import streamlit as st
-import asyncio
 from utils import *
 
 # Get text-to-text FMs
 t2t_fms = list_bedrock_fm_ids(["TEXT"], ["TEXT"], ["ON_DEMAND"])
 
 
-async def get_fm_response(model_id, prompt):
-    """Async wrapper to get response from a foundation model"""
-    return ask_fm(model_id, prompt)
+# Number of model responses displayed per row
+cols_per_row = 3
 
 
-async def main():
+def format_metric(value, precision:int=2):
+    """Format a numeric metric for the results table"""
+    return round(value, precision) if value is not None else "Not provided"
+
+
+def main():
     """Main function for app"""
     st.set_page_config(page_title="fm QA Comparison", layout="wide")
     css = '''
@@ -33,45 +36,53 @@ async def main():
     '''
     st.write(css, unsafe_allow_html=True)
     st.header("Question Answering comparison with Amazon Bedrock FMs")
-    st.markdown("Select two FMs, ask a question or give an instruction and press Enter! Refer the [Demo Overview](Solutions%20Overview) for a description of the solution.")
+    st.markdown("Select two or more FMs, ask a question or give an instruction and press Enter! Refer the [Demo Overview](Solutions%20Overview) for a description of the solution.")
     fm_compare_prompt = st.text_input('Enter question or instruction',key="fm_compare_prompt_key")
     fm_prompt_validation = st.empty()
-    col1, col2, col3 = st.columns([2,2,0.25])
-    with col1:
-        fm_1 = st.selectbox('Select Foundation Model 1',t2t_fms,key="fm_1_key")
-        fm_1_output = st.empty()
-    with col2:
-        fm_2 = st.selectbox('Select Foundation Model 2',t2t_fms,key="fm_2_key")
-        fm_2_output = st.empty()
-    with col3:
-        st.markdown("<br />", unsafe_allow_html=True)
-        if fm_compare_prompt:
-            if len(st.session_state.fm_compare_prompt_key) < 10:
-                with fm_prompt_validation.container():
-                    st.error('Your question must contain at least 10 characters.', icon="🚨")
-            else:
-                prompt = st.session_state.fm_compare_prompt_key
-                model_ids = [st.session_state.fm_1_key, st.session_state.fm_2_key]
-                tasks = []
-                # Start a task for each model ID
-                for model_id in model_ids:
-                    task = asyncio.create_task(get_fm_response(model_id, prompt))
-                    tasks.append(task)
-                # Wait for all tasks to complete
-                results = await asyncio.gather(*tasks)
-                with fm_1_output.container():
-                    response1, _in_tokens1, _out_tokens1 = results[0]
-                    in_tokens1 = _in_tokens1 if _in_tokens1 is not None else "Not provided"
-                    out_tokens1 = _out_tokens1 if _out_tokens1 is not None else "Not provided"
-                    st.markdown(f"""<div id='divshell'>{response1}</div>
-                    <b>Input Tokens:</b> {in_tokens1} | <b>Output Tokens:</b> {out_tokens1}""", unsafe_allow_html=True)
-                with fm_2_output.container():
-                    response2, _in_tokens2, _out_tokens2 = results[1]
-                    in_tokens2 = _in_tokens2 if _in_tokens2 is not None else "Not provided"
-                    out_tokens2 = _out_tokens2 if _out_tokens2 is not None else "Not provided"
-                    st.markdown(f"""<div id='divshell'>{response2}</div>
-                    <b>Input Tokens:</b> {in_tokens2} | <b>Output Tokens:</b> {out_tokens2}""", unsafe_allow_html=True)
+    fms = st.multiselect('Select Foundation Models', t2t_fms, default=t2t_fms[:2], key="fm_compare_fms_key")
+    # Create an output placeholder for each selected FM
+    fm_outputs = {}
+    for row in range(0, len(fms), cols_per_row):
+        for fm, col in zip(fms[row:row + cols_per_row], st.columns(cols_per_row)):
+            with col:
+                st.markdown(f"**{fm}**")
+                fm_outputs[fm] = st.empty()
+    fm_results = st.empty()
+    if fm_compare_prompt:
+        if len(st.session_state.fm_compare_prompt_key) < 10:
+            with fm_prompt_validation.container():
+                st.error('Your question must contain at least 10 characters.', icon="🚨")
+        elif len(fms) < 2:
+            with fm_prompt_validation.container():
+                st.error('Select at least two foundation models to compare.', icon="🚨")
+        else:
+            prompt = st.session_state.fm_compare_prompt_key
+            results = []
+            # Stream all FM responses concurrently and render each one as its deltas arrive
+            for model_id, event, payload in fan_out_fm_streams({fm: (fm, prompt) for fm in fms}):
+                if event == "text":
+                    fm_outputs[model_id].markdown(f"<div id='divshell'>{payload}</div>", unsafe_allow_html=True)
+                elif event == "error":
+                    with fm_outputs[model_id].container():
+                        st.error(payload, icon="🚨")
+                else:
+                    in_tokens = payload["input_tokens"] if payload["input_tokens"] is not None else "Not provided"
+                    out_tokens = payload["output_tokens"] if payload["output_tokens"] is not None else "Not provided"
+                    fm_outputs[model_id].markdown(f"""<div id='divshell'>{payload["text"]}</div>
+                    {token_summary(payload["usage"])}""", unsafe_allow_html=True)
+                    results.append({
+                        "Model ID": model_id,
+                        "Latency (s)": format_metric(payload["latency"]),
+                        "Bedrock Latency (s)": format_metric(payload["server_latency"]),
+                        "Time to First Token (s)": format_metric(payload["time_to_first_token"]),
+                        "Input Tokens": in_tokens,
+                        "Output Tokens": out_tokens,
+                        "Output Tokens/sec": format_metric(payload["tokens_per_sec"], 1),
+                        "Cache Hit": payload["usage"]["cache_hit"]
+                    })
+                    # Results table in order of completion
+                    fm_results.dataframe(pd.DataFrame(results), hide_index=True, use_container_width=True)
 
 # Main  
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,13 +1,12 @@
 import streamlit as st
 from utils import *
+from kb_sync import *
 import time
 import asyncio
 
 
 # Create boto3 clients
-bedrock_agent = boto3.client(service_name='bedrock-agent')
-bedrock_agent_runtime = boto3.client(service_name='bedrock-agent-runtime')
-s3 = boto3.client(service_name='s3')
+bedrock_agent_runtime = get_client('bedrock-agent-runtime')
 
 
 # Get text-to-text FMs
@@ -15,39 +14,51 @@ t2t_fms = list_bedrock_fm_ids(["TEXT"], ["TEXT"], ["ON_DEMAND"])
 
 
 def sync_kb(kb_id:str, ds_id:str):
-    """Synchronize the Bedrock knowledge base with its data source"""
-    job_done = False
-    with st.spinner('Syncing Bedrock knowledge base with data source...'):
-        response = bedrock_agent.start_ingestion_job(
-            knowledgeBaseId=kb_id,
-            dataSourceId=ds_id )
-        sync_job_id = response["ingestionJob"]["ingestionJobId"]
-        while not job_done:
-            time.sleep(1)
-            get_kb_job = bedrock_agent.get_ingestion_job(
-                knowledgeBaseId=kb_id,
-                dataSourceId=ds_id,
-                ingestionJobId=sync_job_id )
-            if get_kb_job["ingestionJob"]["status"] != "STARTING" and get_kb_job["ingestionJob"]["status"] != "IN_PROGRESS":
-                job_done = True
+    """Synchronize the Bedrock knowledge base with its data source in the background"""
+    if kb_id and ds_id:
+        start_kb_sync(kb_id, ds_id)
+
+
+def list_syncs(syncs:list):
+    """Display the status and ingestion statistics of knowledge base syncs"""
+    for sync in syncs:
+        duration = (sync["finished_at"] or time.time()) - sync["started_at"]
+        statistics = ", ".join(f"{label}: {sync['statistics'][name]}" for name, label in SYNC_STATISTICS.items()
+                               if name in sync["statistics"])
+        summary = f"**{sync['kb_id']} / {sync['ds_id']}**: {sync['status']} ({duration:.0f}s)" + (f"  \n{statistics}" if statistics else "")
+        if sync["status"] in ACTIVE_SYNC_STATUSES:
+            st.info(summary, icon="⏳")
+        else:
+            if sync["status"] == "COMPLETE" and not sync["failure_reasons"]:
+                st.success(summary, icon="✅")
+            else:
+                st.error(summary + "  \n" + "  \n".join(sync["failure_reasons"]), icon="🚨")
+            st.button("Dismiss", key=f"dismiss_sync_{sync['kb_id']}_{sync['ds_id']}", on_click=dismiss_kb_sync,
+                      args=(sync["kb_id"], sync["ds_id"]))
 
 
 def upload_docs(docs:list, bucket:str):
-    """Upload the file(s) to the S3 bucket (data source)"""
-    for doc in docs:
-        s3.upload_fileobj(doc, bucket, doc.name)
+    """Upload the file(s) to the S3 bucket (data source) concurrently, skipping unchanged files"""
+    try:
+        st.session_state.rag_kb_upload_stats = upload_to_s3(docs, bucket)
+    except ClientError as e:
+        st.session_state.rag_kb_upload_stats = {"error": e.response["Error"]["Message"]}
   
 
 async def ask_fm_rag_off(prompt:str, modelid:str):
     """FM query - RAG disabled"""
-    return ask_fm(modelid, prompt)
+    return await run_in_fm_pool(collect_fm_stream, ask_fm_stream(modelid, prompt))
 
 
 async def ask_fm_rag_on(prompt:str, modelid:str, kb_id:str):
     """FM contextual query - RAG enabled, powered by Bedrock's knowledge base"""
+    return await run_in_fm_pool(fm_rag_query, prompt, modelid, kb_id)
+
+
+def fm_rag_query(prompt:str, modelid:str, kb_id:str):
+    """Retrieve context from the Bedrock knowledge base and query the FM with the augmented prompt"""
     global augmented_prompt
-    global top_k
-    top_k = 3
+    global context_stats
     kb_response = bedrock_agent_runtime.retrieve(
         knowledgeBaseId=kb_id,
         retrievalQuery={
@@ -55,15 +66,16 @@ async def ask_fm_rag_on(prompt:str, modelid:str, kb_id:str):
         },
     retrievalConfiguration={
         'vectorSearchConfiguration': {
-            'numberOfResults': top_k
+            'numberOfResults': RAG_CONTEXT_CANDIDATES
         }}
     )
-    result_text = []
+    results = kb_response["retrievalResults"]
+    # Pack the best chunks into the token budget
+    context_stats = build_context(modelid, [r["content"]["text"] for r in results])
+    context = context_stats.pop("context")
     unique_sources = set()
-    for r in kb_response["retrievalResults"]:
-        result_text.append(r["content"]["text"])
-        unique_sources.add(r["location"]["s3Location"]["uri"])
-    context = ' '.join(result_text)
+    for i in context_stats["chunks"]:
+        unique_sources.add(results[i]["location"]["s3Location"]["uri"])
     unique_sources_list = list(unique_sources)
     augmented_prompt = f"""
     Use only the following context to provide a concise answer to the question at the end. Skip the preamble and avoid mentioning the context.
@@ -76,8 +88,8 @@ async def ask_fm_rag_on(prompt:str, modelid:str, kb_id:str):
     {prompt}
     </question>
     """
-    response, in_tokens, out_tokens = ask_fm(modelid,augmented_prompt)
-    return response, in_tokens, out_tokens, unique_sources_list
+    response, usage = collect_fm_stream(ask_fm_stream(modelid, augmented_prompt))
+    return response, usage, unique_sources_list
 
 
 async def main():
@@ -121,6 +133,16 @@ async def main():
                 st.button("Submit Documents", type="primary", on_click=upload_docs, args=(st.session_state.rag_kb_docs_key, st.session_state.rag_s3_key))
         with col1_col2:
             st.button("Sync KB", type="primary", on_click=sync_kb, args=(st.session_state.rag_kb_key, st.session_state.rag_ds_key))
+        upload_stats = st.session_state.get("rag_kb_upload_stats")
+        if upload_stats is not None:
+            if "error" in upload_stats:
+                st.error(upload_stats["error"], icon="🚨")
+            else:
+                st.caption(f"Uploaded {upload_stats['uploaded']} file(s) ({upload_stats['bytes'] / 1024 / 1024:.1f} MB) in {upload_stats['seconds']:.1f}s "
+                           f"({upload_stats['mb_per_sec']:.1f} MB/s), skipped {upload_stats['skipped']} unchanged file(s)")
+        syncs = list_kb_syncs()
+        active_syncs = any(sync["status"] in ACTIVE_SYNC_STATUSES for sync in syncs)
+        list_syncs(syncs)
     with col2:
         rag_fm_prompt = st.text_input('Enter your question or instruction for information from the uploaded document(s)', key="rag_fm_prompt_key",label_visibility="visible")
         rag_fm_prompt_validation = st.empty()
@@ -142,23 +164,27 @@ async def main():
                 tasks.extend([task1, task2])
                 results = await asyncio.gather(*tasks)
                 with rag_disabled_response.container():
-                    response_rag_off, _in_tokens, _out_tokens = results[0]
-                    in_tokens = _in_tokens if _in_tokens is not None else "Not provided"
-                    out_tokens = _out_tokens if _out_tokens is not None else "Not provided"
+                    response_rag_off, usage_rag_off = results[0]
                     st.markdown(f"""<div id='divshell' style='background-color: #fdf1f2;'>
                     <p style='text-align: center;font-weight: bold;'>Without RAG ( {rag_fm} )</p>
                     {response_rag_off}</div>
-                    <b>Input Tokens:</b> {in_tokens} | <b>Output Tokens:</b> {out_tokens}""", unsafe_allow_html=True)
+                    {token_summary(usage_rag_off)}""", unsafe_allow_html=True)
                 with rag_enabled_response.container():
-                    response, _in_tokens, _out_tokens, sources_list = results[1]
-                    in_tokens = _in_tokens if _in_tokens is not None else "Not provided"
-                    out_tokens = _out_tokens if _out_tokens is not None else "Not provided"
+                    response, usage, sources_list = results[1]
                     cs_sources = "\n".join([f"({i+1}) {item}" for i, item in enumerate(sources_list)])
                     st.markdown(f"""<div id='divshell' style='background-color: #f1fdf1;'><p style='text-align: center;font-weight: bold;'>With RAG ( {rag_fm} )</p>
                     {response}<br /><b>Source(s): </b>\n{cs_sources}</div>
-                    <b>Input Tokens:</b> {in_tokens} | <b>Output Tokens:</b> {out_tokens}<br /><br />""", unsafe_allow_html=True)
-                    expander = st.expander(f"See augmented prompt with top {top_k} search results from source(s) ({in_tokens} tokens)")
+                    {token_summary(usage)}<br /><br />""", unsafe_allow_html=True)
+                    expander = st.expander(f"See augmented prompt with {len(context_stats['chunks'])} of {context_stats['retrieved']} search results from source(s) "
+                                           f"({context_stats['tokens']} of {context_stats['budget']} context tokens, {usage['input_tokens']} prompt tokens)")
                     expander.write(augmented_prompt)
+                    # Keep the answers displayed - the sync status is refreshed on the next interaction
+                    active_syncs = False
+    if active_syncs:
+        # Refresh the status of the background syncs (read from memory - the syncs are polled in the background).
+        # A rerun triggered by a widget interrupts this one, so the page stays interactive.
+        time.sleep(1)
+        st.rerun()
 
 
 # Main  
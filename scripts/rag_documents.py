@@ -1,12 +1,11 @@
 import streamlit as st
 import os
 import asyncio
+import uuid
 from pathlib import Path, PurePath
-from langchain.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.document_loaders import DirectoryLoader
-from langchain.vectorstores import FAISS
 from utils import *
+from vector_store import *
+from ingestion import *
 
 
 # Directories
@@ -25,59 +24,56 @@ if not os.path.exists(VECTOR_STORE_DIR):
 t2t_fms = list_bedrock_fm_ids(["TEXT"], ["TEXT"], ["ON_DEMAND"])
 
 
+def get_jobs() -> IngestionJobs:
+    """Get the background ingestion job queue, which moves processed files to the input directory"""
+    return get_ingestion_jobs(UPLOAD_DIR, INPUT_DIR, get_document_index(VECTOR_STORE_DIR), bedrock_embeddings)
+
+
 def process_docs(in_dir:str, out_dir:str):
-    """Save uploaded files, process files for embeddings and move processed files"""
-    with st.spinner('Splitting files, generating and storing embeddings...'):
-        for doc in st.session_state.rag_docs_key:
-            upload_path = Path(UPLOAD_DIR, doc.name)
-            with open(upload_path, mode='wb') as w:
-                w.write(doc.getvalue())
-        pdf_chunks = split_pdfs(in_dir)
-        st.session_state.faiss_vector_db = embeddings_faiss(pdf_chunks,VECTOR_STORE_DIR, bedrock_embeddings)                
-        for f in os.listdir(in_dir):
-            src_path = os.path.join(in_dir, f)
-            dst_path = os.path.join(out_dir, f)
-            os.rename(src_path, dst_path)
-        
-   
+    """Save uploaded files and submit a background job to process them for embeddings"""
+    job_dir = Path(in_dir, uuid.uuid4().hex)
+    os.makedirs(job_dir)
+    for doc in st.session_state.rag_docs_key:
+        with open(Path(job_dir, doc.name), mode='wb') as w:
+            w.write(doc.getvalue())
+    get_jobs().submit(job_dir, [doc.name for doc in st.session_state.rag_docs_key])
+
+
+def list_jobs(jobs:list):
+    """Display the progress of ingestion jobs, with buttons to cancel active jobs and retry failed jobs"""
+    for job in jobs:
+        files = ", ".join(json.loads(job["files"]))
+        pages = job["pages_done"] + job["file_pages"]
+        chunks = job["chunks"] + job["file_chunks"]
+        if job["status"] in ACTIVE_JOB_STATUSES:
+            total = job["total_pages"]
+            st.progress(min(pages / total, 1.0) if total else 0.0,
+                        text=f"{files}: {job['status']}" + (f" - {pages} of {total} pages ({chunks} chunks)" if total else ""))
+            if job["status"] != "cancelling":
+                st.button("Cancel", key=f"cancel_job_{job['id']}", on_click=get_jobs().cancel, args=(job["id"],))
+        elif job["status"] == "failed":
+            st.error(f"{files}: {job['error']}", icon="🚨")
+            retry_col, discard_col = st.columns([1, 1])
+            retry_col.button("Retry", key=f"retry_job_{job['id']}", on_click=get_jobs().retry, args=(job["id"],))
+            discard_col.button("Discard", key=f"discard_job_{job['id']}", on_click=get_jobs().cancel, args=(job["id"],))
+        else:
+            st.caption(f"{files}: {job['status']} ({chunks} chunks)")
+
+
+
+def delete_doc(doc_name:str):
+    """Delete a processed document and its chunks from the vector datastore"""
+    os.remove(os.path.join(INPUT_DIR, doc_name))
+    get_document_index(VECTOR_STORE_DIR).delete_source(doc_name)
+
+
 def list_files(dir:str):
-    """Display file listing for a directory"""
+    """Display file listing for a directory, with a button to delete each file"""
     if len(os.listdir(dir)) > 0:
         for i,f in enumerate(os.listdir(dir)):
-            st.markdown(f"-  {f}",unsafe_allow_html=True)
-
-
-def split_pdfs(pdf_dir:str) -> list:
-    """Load PDFs from a directory and split PDFs into tokens"""
-    if os.listdir(pdf_dir):
-        loader = DirectoryLoader(pdf_dir, loader_cls=PyPDFLoader)
-        documents = loader.load()
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=0,
-            separators=["\n", "\n\n", "(?<=\. )"]
-            )
-        document_chunks = text_splitter.split_documents(documents)
-        return document_chunks
-
-
-def embeddings_faiss(doc_list:list, db_dir:str, embeddings_fn):
-    """Generate embeddings for document chunks and store in a FAISS vector datastore"""
-    if doc_list:
-        new_db = FAISS.from_documents(doc_list, embeddings_fn)
-        if os.listdir(db_dir):
-            local_db = FAISS.load_local(db_dir, embeddings_fn)
-            local_db.merge_from(new_db)
-            local_db.save_local(db_dir)
-            return local_db
-        else:
-            new_db.save_local(db_dir)
-            return new_db
-    elif os.listdir(db_dir):
-        local_db = FAISS.load_local(db_dir, embeddings_fn)
-        return local_db
-    else:
-        return None
+            file_col, delete_col = st.columns([0.85, 0.15])
+            file_col.markdown(f"-  {f}",unsafe_allow_html=True)
+            delete_col.button("🗑️", key=f"delete_doc_{f}", help=f"Delete {f}", on_click=delete_doc, args=(f,))
 
 
 def empty_dir(data_dir:str):
@@ -86,29 +82,39 @@ def empty_dir(data_dir:str):
         os.remove(os.path.join(data_dir, f))
       
 
+
 async def ask_fm_rag_off(prompt:str, modelid:str):
     """FM query - RAG disabled"""
-    return ask_fm(modelid, prompt)
+    return await run_in_fm_pool(collect_fm_stream, ask_fm_stream(modelid, prompt))
 
 
 async def ask_fm_rag_on(prompt:str, modelid:str, vector_db):
     """FM contextual query - RAG enabled"""
+    return await run_in_fm_pool(fm_rag_query, prompt, modelid, vector_db)
+
+
+def fm_rag_query(prompt:str, modelid:str, vector_db):
+    """Retrieve context from the vector datastore and query the FM with the augmented prompt"""
     global augmented_prompt
-    global top_k
-    top_k = 3
-    retriever = vector_db.as_retriever(search_kwargs={"k": top_k})
-    results = retriever.invoke(prompt)
-    result_text = []
+    global context_stats
+    # Return the answer to a near-identical question asked against the same vector datastore, if any
+    prompt_vector = bedrock_embeddings.embed_query(prompt)
+    index_version = vector_db.version
+    cached = semantic_cache_lookup(prompt_vector, modelid, index_version)
+    if cached is not None:
+        augmented_prompt = cached["augmented_prompt"]
+        context_stats = cached["context_stats"]
+        return cached["response"], dict(cached["usage"], cache_hit=True), cached["sources"]
+    results = vector_db.search(prompt_vector, k=RAG_CONTEXT_CANDIDATES, query_text=prompt)
+    # Pack the best chunks into the token budget
+    context_stats = build_context(modelid, [document.page_content for document in results])
+    context = context_stats.pop("context")
     unique_sources = set()
-    for document in results:
-        # Extract text content from the document
-        page_content = document.page_content.strip()
-        result_text.append(page_content)
+    for i in context_stats["chunks"]:
         # Extract source from the metadata
-        source = document.metadata.get('source', 'Unknown')
+        source = results[i].metadata.get('source', 'Unknown')
         filename = source.split('/')[-1]
         unique_sources.add(filename)
-    context = ' '.join(result_text)
     unique_sources_list = list(unique_sources)
     augmented_prompt = f"""
     Use only the following context to provide a concise answer to the question at the end. Skip the preamble. Avoid mentioning the context.
@@ -121,8 +127,11 @@ async def ask_fm_rag_on(prompt:str, modelid:str, vector_db):
     {prompt}
     </question>
     """
-    response, in_tokens, out_tokens = ask_fm(modelid,augmented_prompt)
-    return response, in_tokens, out_tokens, unique_sources_list         
+    response, usage = collect_fm_stream(ask_fm_stream(modelid, augmented_prompt))
+    semantic_cache_add(prompt_vector, modelid, index_version,
+                       {"response": response, "usage": usage, "sources": unique_sources_list, "augmented_prompt": augmented_prompt,
+                        "context_stats": context_stats})
+    return response, usage, unique_sources_list         
 
 
 async def main():
@@ -159,13 +168,16 @@ async def main():
         rag_docs = st.file_uploader(label="Upload Documents", type="pdf", accept_multiple_files=True, key="rag_docs_key")
         if st.session_state.rag_docs_key is not None:
             st.button("Submit Documents", type="primary", on_click=process_docs, args=(UPLOAD_DIR, INPUT_DIR))
+        jobs = get_jobs().jobs()
+        active_jobs = any(job["status"] in ACTIVE_JOB_STATUSES for job in jobs)
+        list_jobs(jobs)
         files = st.empty()
         with files.container():
             list_files(INPUT_DIR)
-        if len(os.listdir(INPUT_DIR)) > 0:
+        if len(os.listdir(INPUT_DIR)) > 0 and not active_jobs:
             if st.button("Delete Documents", type="primary"):
                 empty_dir(INPUT_DIR)
-                empty_dir(VECTOR_STORE_DIR)
+                get_document_index(VECTOR_STORE_DIR).clear()
                 with files.container():
                     list_files(INPUT_DIR)
                 st.rerun()
@@ -181,45 +193,52 @@ async def main():
         st.markdown("<br />", unsafe_allow_html=True)
         if st.button("Ask!", type="primary"):
             if rag_fm_prompt is not None:
-                if 'faiss_vector_db' not in st.session_state:
-                    st.session_state.faiss_vector_db = None
+                vector_db = get_document_index(VECTOR_STORE_DIR)
                 with rag_fm_prompt_validation.container():
                     if len(rag_fm_prompt) < 10:
                         st.error('Your question or instruction must contain at least 10 characters.', icon="🚨")
-                    elif len(os.listdir(INPUT_DIR)) == 0 and len(os.listdir(VECTOR_STORE_DIR)) == 0:
-                        st.session_state.faiss_vector_db = None
+                    elif len(os.listdir(INPUT_DIR)) == 0 and get_jobs().active():
+                        # Documents are moved to the input directory once indexed, so the index must be kept
+                        st.info('Your documents are being processed. Ask again once they are ready.', icon="⏳")
+                        active_jobs = True
+                    elif len(os.listdir(INPUT_DIR)) == 0:
+                        if len(vector_db) > 0:
+                            vector_db.clear()
                         st.error('There are no PDF documents for RAG. Please upload at least one document.', icon="🚨")
-                    elif len(os.listdir(INPUT_DIR)) == 0 and len(os.listdir(VECTOR_STORE_DIR)) > 0:
-                        empty_dir(VECTOR_STORE_DIR)
-                        st.session_state.faiss_vector_db = None
-                    elif len(os.listdir(INPUT_DIR)) > 0 and len(os.listdir(VECTOR_STORE_DIR)) == 0:
-                        pdf_chunks = split_pdfs(INPUT_DIR)
-                        st.session_state.faiss_vector_db = embeddings_faiss(pdf_chunks,VECTOR_STORE_DIR, bedrock_embeddings)
-                    elif len(os.listdir(INPUT_DIR)) > 0 and len(os.listdir(VECTOR_STORE_DIR)) > 0:
-                        st.session_state.faiss_vector_db = embeddings_faiss([],VECTOR_STORE_DIR, bedrock_embeddings)
+                    elif len(vector_db) == 0:
+                        if not get_jobs().active():
+                            # Rebuild the vector datastore from the processed documents in the background (embeddings are cached)
+                            get_jobs().submit_rebuild(sorted(os.listdir(INPUT_DIR)))
+                        st.info('The vector datastore is being built from the processed documents. Ask again once it is ready.', icon="⏳")
+                        active_jobs = True
+                    else:
                         tasks = []
                         task1 = asyncio.create_task(ask_fm_rag_off(rag_fm_prompt, rag_fm))
-                        task2 = asyncio.create_task(ask_fm_rag_on(rag_fm_prompt, rag_fm, st.session_state.faiss_vector_db))
+                        task2 = asyncio.create_task(ask_fm_rag_on(rag_fm_prompt, rag_fm, vector_db))
                         tasks.extend([task1, task2])
                         results = await asyncio.gather(*tasks)
                         with rag_disabled_response.container():
-                            response_rag_off, _in_tokens, _out_tokens = results[0]
-                            in_tokens = _in_tokens if _in_tokens is not None else "Not provided"
-                            out_tokens = _out_tokens if _out_tokens is not None else "Not provided"
+                            response_rag_off, usage_rag_off = results[0]
                             st.markdown(f"""<div id='divshell' style='background-color: #fdf1f2;'>
                             <p style='text-align: center;font-weight: bold;'>Without RAG ( {rag_fm} )</p>
                             {response_rag_off}</div>
-                            <b>Input Tokens:</b> {in_tokens} | <b>Output Tokens:</b> {out_tokens}""", unsafe_allow_html=True)
+                            {token_summary(usage_rag_off)}""", unsafe_allow_html=True)
                         with rag_enabled_response.container():
-                            response, _in_tokens, _out_tokens, sources_list = results[1]
-                            in_tokens = _in_tokens if _in_tokens is not None else "Not provided"
-                            out_tokens = _out_tokens if _out_tokens is not None else "Not provided"
+                            response, usage, sources_list = results[1]
                             cs_sources = "\n".join([f"({i+1}) {item}" for i, item in enumerate(sources_list)])
                             st.markdown(f"""<div id='divshell' style='background-color: #f1fdf1;'><p style='text-align: center;font-weight: bold;'>With RAG ( {rag_fm} )</p>
                             {response}<br /><b>Source(s): </b>\n{cs_sources}</div>
-                            <b>Input Tokens:</b> {in_tokens} | <b>Output Tokens:</b> {out_tokens}<br /><br />""", unsafe_allow_html=True)
-                            expander = st.expander(f"See augmented prompt with top {top_k} search results from source(s) ({in_tokens} tokens)")
+                            {token_summary(usage)}<br /><br />""", unsafe_allow_html=True)
+                            expander = st.expander(f"See augmented prompt with {len(context_stats['chunks'])} of {context_stats['retrieved']} search results from source(s) "
+                                                   f"({context_stats['tokens']} of {context_stats['budget']} context tokens, {usage['input_tokens']} prompt tokens)")
                             expander.write(augmented_prompt)
+                            # Keep the answers displayed - the job progress is refreshed on the next interaction
+                            active_jobs = False
+    if active_jobs:
+        # Poll the progress of the background ingestion jobs (the page stays interactive, since a rerun triggered
+        # by a widget interrupts this one)
+        time.sleep(1)
+        st.rerun()
 
 
 # Main  
@@ -1,30 +1,26 @@
 import streamlit as st
 import re
 import asyncio
-from langchain.vectorstores import FAISS
 from utils import *
+from vector_store import *
 
 
-async def similarity_search(query:str, text:str) -> str:
-    """Similarity search using LangChain, Bedrock's Titan embeddings and FAISS"""
-    bedrock_embeddings = BedrockEmbeddings(client=bedrock_runtime)
-    sentences_list = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s', text)
-    faiss = FAISS.from_texts(sentences_list, bedrock_embeddings)
-    results = faiss.similarity_search(query,1)
+def similarity_search(query:str, text:str) -> str:
+    """Similarity search using Bedrock's Titan embeddings and a sentence index of the text (embedded once per text)"""
+    sentences_list = [s for s in re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s', text) if s.strip()]
+    if not sentences_list:
+        return "No matches for similarity search!"
+    sentence_index = get_sentence_index(sentences_list, bedrock_embeddings)
+    results = sentence_index.search([bedrock_embeddings.embed_query(query)], k=1)[0]
     result = ""
-    for r in range(len(results)):
-        result = result + "\n" + results[r].page_content
+    for sentence, _ in results:
+        result = result + "\n" + sentence
     if result:
         return result
     else:
         return "No matches for similarity search!"
     
 
-async def get_fm_response(model_id, prompt):
-    """Async wrapper to get response from a foundation model"""
-    return ask_fm(model_id, prompt)
-
-
 async def main():
     """Main function for text querying"""
     st.set_page_config(page_title="Text Query", layout="wide")
@@ -65,8 +61,8 @@ async def main():
         <context>{text}</context>
         <question>{st.session_state.search_string_key}</question>
         """
-        task1 = asyncio.create_task(similarity_search(st.session_state.search_string_key, text))
-        task2 = asyncio.create_task(get_fm_response(model_id, prompt))
+        task1 = asyncio.create_task(run_in_fm_pool(similarity_search, st.session_state.search_string_key, text))
+        task2 = asyncio.create_task(run_in_fm_pool(collect_fm_stream, ask_fm_stream(model_id, prompt, params={"max_tokens": 256})))
         tasks.extend([task1, task2])
         results = await asyncio.gather(*tasks)
         with col1:
@@ -76,10 +72,10 @@ async def main():
             <b>NOTE:</b> A similarity search uses vector representations (embeddings) of the text
             and so the response comprises part of the <u>original text</u> that is most semantically similar to the query.""", unsafe_allow_html=True)
         with col2:
-            fm_response, in_tokens, out_tokens = results[1]
+            fm_response, usage = results[1]
             st.markdown(f"""<div id='divshell' style='background-color: #f1fdf1;'>
             <p style='text-align: center;font-weight: bold;'>FM Contextual Query ({model_id})</p>{fm_response}<br /></div>
-            <b>Input Tokens:</b> {in_tokens} | <b>Output Tokens:</b> {out_tokens}
+            {token_summary(usage)}
             <br /><br />
             <b>NOTE:</b> By simply passing the entire original text to an FM, the FM will attempt to provide a meaningful response
             based on its understanding of the text and query.""", unsafe_allow_html=True)
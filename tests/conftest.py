@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The application modules are at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Importing utils creates AWS clients, which need a region
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
@@ -0,0 +1,63 @@
+import io
+import os
+import pytest
+from boto3.s3.transfer import TransferConfig
+from moto import mock_aws
+import utils
+import kb_sync
+
+
+BUCKET = "docs-bucket"
+MB = 1024 * 1024
+
+
+class UploadedFile(io.BytesIO):
+    """Stand-in for a Streamlit uploaded file"""
+
+    def __init__(self, name:str, data:bytes):
+        super().__init__(data)
+        self.name = name
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    """An S3 bucket in a local S3 stand-in, with a 5 MB multipart threshold"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setattr(kb_sync, "s3_transfer_config", TransferConfig(multipart_threshold=5 * MB, multipart_chunksize=5 * MB))
+    with mock_aws():
+        # Clients must be created inside the mock
+        monkeypatch.setattr(utils, "boto_clients", {})
+        utils.get_client("s3").create_bucket(Bucket=BUCKET)
+        yield BUCKET
+
+
+def test_upload_to_s3_uploads_new_files(bucket):
+    docs = [UploadedFile("small.pdf", os.urandom(1000)), UploadedFile("large.pdf", os.urandom(12 * MB))]
+    stats = kb_sync.upload_to_s3(docs, bucket)
+    assert stats["uploaded"] == 2
+    assert stats["skipped"] == 0
+    assert stats["bytes"] == 1000 + 12 * MB
+    for doc in docs:
+        body = utils.get_client("s3").get_object(Bucket=bucket, Key=doc.name)["Body"].read()
+        assert body == doc.getvalue()
+
+
+def test_upload_to_s3_skips_unchanged_files(bucket):
+    docs = [UploadedFile("small.pdf", os.urandom(1000)), UploadedFile("large.pdf", os.urandom(12 * MB))]
+    kb_sync.upload_to_s3(docs, bucket)
+    # The large file was uploaded in parts, so its ETag is not the MD5 of its content
+    etag = utils.get_client("s3").head_object(Bucket=bucket, Key="large.pdf")["ETag"]
+    assert "-" in etag
+    stats = kb_sync.upload_to_s3(docs, bucket)
+    assert stats["uploaded"] == 0
+    assert stats["skipped"] == 2
+    assert stats["bytes"] == 0
+
+
+def test_upload_to_s3_uploads_changed_files(bucket):
+    kb_sync.upload_to_s3([UploadedFile("doc.pdf", b"original"), UploadedFile("same.pdf", b"same")], bucket)
+    stats = kb_sync.upload_to_s3([UploadedFile("doc.pdf", b"changed"), UploadedFile("same.pdf", b"same")], bucket)
+    assert stats["uploaded"] == 1
+    assert stats["skipped"] == 1
+    assert utils.get_client("s3").get_object(Bucket=bucket, Key="doc.pdf")["Body"].read() == b"changed"
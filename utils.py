@@ -2,13 +2,127 @@ import boto3
 import pandas as pd
 import numpy as np
 import json
-from langchain.embeddings import BedrockEmbeddings
+import os
+import re
+import math
+import asyncio
+import functools
+import itertools
+import queue
+import time
+import threading
+import hashlib
+import random
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+from langchain.schema.output import Generation, GenerationChunk, LLMResult
+
+# Cap on concurrent model invocations, enforced by invoke_fm, converse_fm and ask_fm_stream in whichever thread
+# calls them (a stream holds its slot until it is complete or closed), so it applies across all pages and sessions
+# of the process (avoids Bedrock throttling). Blocking calls are run in a shared thread pool of the same size.
+FM_MAX_CONCURRENCY = int(os.environ.get("BEDROCK_FM_MAX_CONCURRENCY", "8"))
+fm_semaphore = threading.BoundedSemaphore(FM_MAX_CONCURRENCY)
+fm_executor = ThreadPoolExecutor(max_workers=FM_MAX_CONCURRENCY, thread_name_prefix="bedrock-fm")
+# Separate thread pool for embedding requests, so document ingestion does not starve FM invocations
+EMBEDDINGS_MAX_CONCURRENCY = int(os.environ.get("BEDROCK_EMBEDDINGS_MAX_CONCURRENCY", "8"))
+embeddings_executor = ThreadPoolExecutor(max_workers=EMBEDDINGS_MAX_CONCURRENCY, thread_name_prefix="bedrock-embeddings")
+
+# Shared boto3 clients - tuned for connection reuse across Streamlit reruns and sessions
+BOTO_MAX_POOL_CONNECTIONS = int(os.environ.get("BOTO_MAX_POOL_CONNECTIONS", str(max(50, 2 * FM_MAX_CONCURRENCY))))
+boto_config = Config(
+    max_pool_connections=BOTO_MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    retries={"mode": "adaptive", "max_attempts": int(os.environ.get("BOTO_MAX_ATTEMPTS", "5"))}
+)
+boto_clients = {}
+boto_clients_lock = threading.Lock()
+
+
+def get_client(service_name:str):
+    """Get the shared boto3 client for an AWS service, creating it on first use"""
+    with boto_clients_lock:
+        if service_name not in boto_clients:
+            boto_clients[service_name] = boto3.client(service_name=service_name, config=boto_config)
+        return boto_clients[service_name]
+
+
+def client_pool_stats() -> list:
+    """List connection pool statistics (per service and host) for the shared boto3 clients"""
+    stats = []
+    with boto_clients_lock:
+        clients = list(boto_clients.items())
+    for service_name, client in clients:
+        # botocore does not expose its urllib3 pool manager publicly
+        manager = client._endpoint.http_session._manager
+        for pool_key in manager.pools.keys():
+            pool = manager.pools.get(pool_key)
+            if pool is None:
+                continue
+            stats.append({
+                "Service": service_name,
+                "Host": pool.host,
+                "Max Connections": pool.pool.maxsize,
+                "Connections Opened": pool.num_connections,
+                "Idle Connections": sum(1 for conn in list(pool.pool.queue) if conn is not None),
+                "Requests": pool.num_requests
+            })
+    return stats
+
 
 # Create bedrock boto3 clients
-bedrock = boto3.client(service_name='bedrock')
-bedrock_runtime = boto3.client(service_name='bedrock-runtime')
-# Create bedrock_embeddings instance using LangChain
-bedrock_embeddings = BedrockEmbeddings(client=bedrock_runtime)
+bedrock = get_client('bedrock')
+bedrock_runtime = get_client('bedrock-runtime')
+
+# Directory for caches persisted on local disk
+CACHE_DIR = Path(__file__).resolve().parent.joinpath('', '.cache')
+if not os.path.exists(CACHE_DIR):
+   os.makedirs(CACHE_DIR)
+
+# Cache of the Bedrock FM catalog (list_foundation_models), held in-process and optionally persisted to disk
+FM_CATALOG_TTL = int(os.environ.get("BEDROCK_FM_CATALOG_TTL", "86400"))
+FM_CATALOG_PERSIST = os.environ.get("BEDROCK_FM_CATALOG_PERSIST", "true").lower() == "true"
+FM_CATALOG_FILE = CACHE_DIR.joinpath('', 'fm_catalog.json')
+fm_catalog = {"models": None, "fetched_at": 0}
+fm_catalog_lock = threading.Lock()
+
+
+def refresh_fm_catalog() -> list:
+    """Fetch the Bedrock FM catalog and update the in-process and disk caches"""
+    models = bedrock.list_foundation_models()['modelSummaries']
+    with fm_catalog_lock:
+        fm_catalog["models"] = models
+        fm_catalog["fetched_at"] = time.time()
+        if FM_CATALOG_PERSIST:
+            tmp_file = FM_CATALOG_FILE.with_suffix('.tmp')
+            with open(tmp_file, mode='w') as w:
+                json.dump(fm_catalog, w)
+            os.replace(tmp_file, FM_CATALOG_FILE)
+    return models
+
+
+def get_fm_catalog(refresh:bool = False) -> list:
+    """
+    Get the summaries of all Bedrock FMs from the in-process cache, the disk cache or Bedrock (in that order),
+    reading from Bedrock only when the cached catalog is older than BEDROCK_FM_CATALOG_TTL seconds or refresh is True.
+    """
+    if not refresh:
+        with fm_catalog_lock:
+            if fm_catalog["models"] is not None and time.time() - fm_catalog["fetched_at"] < FM_CATALOG_TTL:
+                return fm_catalog["models"]
+            if FM_CATALOG_PERSIST and os.path.exists(FM_CATALOG_FILE):
+                with open(FM_CATALOG_FILE) as r:
+                    cached = json.load(r)
+                if time.time() - cached["fetched_at"] < FM_CATALOG_TTL:
+                    fm_catalog.update(cached)
+                    return fm_catalog["models"]
+    return refresh_fm_catalog()
 
 
 def list_bedrock_fm_ids(input_modality:list =  ['ALL'],
@@ -25,7 +139,7 @@ def list_bedrock_fm_ids(input_modality:list =  ['ALL'],
       parameter.remove('ALL')
 
   # List all Bedrock FMs
-  models = bedrock.list_foundation_models()['modelSummaries']
+  models = get_fm_catalog()
   modelids = []
 
   # Loop through each model and check if it matches the given filter parameters
@@ -54,7 +168,7 @@ def generate_bedrock_fm_table():
     """
     Generate a table of all available Bedrock foundation models.
     """
-    models = bedrock.list_foundation_models()['modelSummaries']
+    models = get_fm_catalog()
     
     # Dictionary of lists where each list represents a row in the table
     provider_name = []
@@ -95,84 +209,791 @@ def generate_bedrock_fm_table():
     return df, unique_names, color_map
 
     
-def ask_fm(modelid:str, prompt:str) -> str:
-    """Invoke specific FM using boto3 and pass prompt and max tokens - all other inference parameters will use default values"""
-    unsupported = False
+# Content-addressed embedding cache - float32 vectors stored as binary blobs in SQLite
+EMBEDDINGS_CACHE_DB = CACHE_DIR.joinpath('', 'embeddings.db')
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    LangChain embeddings that consult an on-disk cache keyed by the hash of the embedding model ID and the text
+    before calling the underlying embeddings model, so unchanged text is never embedded twice. For models that embed
+    documents and queries differently (input types), the input type is part of the key.
+    """
+
+    def __init__(self, embeddings, db_path = EMBEDDINGS_CACHE_DB):
+        self.embeddings = embeddings
+        self.model_id = embeddings.model_id
+        self.input_types = getattr(embeddings, "input_types", True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.db.commit()
+
+    def key(self, text:str, input_type:str = "search_document") -> str:
+        """Cache key for the embedding of a text as a document or a query (input type search_document or search_query)"""
+        if self.input_types:
+            return hashlib.sha256(f"{self.model_id}\0{input_type}\0{text}".encode()).hexdigest()
+        return hashlib.sha256(f"{self.model_id}\0{text}".encode()).hexdigest()
+
+    def lookup(self, keys:list) -> dict:
+        """Get the cached vectors for a list of keys"""
+        vectors = {}
+        with self.lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self.db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch)
+                vectors.update((key, np.frombuffer(vector, dtype=np.float32).tolist()) for key, vector in rows)
+        return vectors
+
+    def store(self, keys:list, vectors:list):
+        """Store vectors in the cache"""
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in zip(keys, vectors)])
+            self.db.commit()
+
+    def embed_documents(self, texts:list, on_progress=None) -> list:
+        """
+        Embed a list of texts, calling the embeddings model only for texts that are not cached.
+        If on_progress is provided, it is called with the number of texts embedded so far and the total.
+        """
+        keys = [self.key(text) for text in texts]
+        cached = self.lookup(list(set(keys)))
+        missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+        done = len(texts) - len(missing)
+        if on_progress is not None:
+            on_progress(done, len(texts))
+        if missing:
+            progress = None if on_progress is None else lambda embedded, total: on_progress(done + embedded, len(texts))
+            vectors = self.embeddings.embed_documents(list(missing.values()), on_progress=progress)
+            self.store(list(missing.keys()), vectors)
+            cached.update(zip(missing.keys(), vectors))
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text:str) -> list:
+        """Embed a query text, using the cache if it has been embedded before"""
+        key = self.key(text, input_type="search_query")
+        cached = self.lookup([key])
+        if key in cached:
+            return cached[key]
+        vector = self.embeddings.embed_query(text)
+        self.store([key], [vector])
+        return vector
+
+
+class BedrockBatchEmbeddings(Embeddings):
+    """
+    LangChain embeddings for Bedrock embedding models that send requests concurrently in the embeddings thread pool,
+    retry throttled requests with exponential backoff and batch texts for models that accept multiple texts per request.
+    """
+    # Maximum number of texts per request for batch-capable embedding models
+    batch_sizes = {"cohere.embed": 96}
+    retryable_errors = ("ThrottlingException", "ServiceUnavailableException", "ModelNotReadyException", "ModelTimeoutException")
+
+    def __init__(self, model_id:str, max_attempts:int = 8):
+        self.model_id = model_id
+        self.max_attempts = max_attempts
+        self.batch_size = next((size for prefix, size in self.batch_sizes.items() if model_id.startswith(prefix)), 1)
+        # Whether the model embeds documents and queries differently
+        self.input_types = model_id.startswith("cohere.embed")
+
+    def request_body(self, texts:list, input_type:str) -> str:
+        """Build the request body for a batch of texts"""
+        if self.model_id.startswith("cohere.embed"):
+            return json.dumps({"texts": texts, "input_type": input_type})
+        return json.dumps({"inputText": texts[0]})
+
+    def invoke(self, texts:list, input_type:str = "search_document") -> list:
+        """Embed a batch of texts with a single request, retrying with exponential backoff and jitter when throttled"""
+        body = self.request_body(texts, input_type)
+        for attempt in range(self.max_attempts):
+            try:
+                response = bedrock_runtime.invoke_model(body=body, modelId=self.model_id, accept="application/json", contentType="application/json")
+                break
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in self.retryable_errors or attempt == self.max_attempts - 1:
+                    raise
+                time.sleep(min(20, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        response_body = json.loads(response["body"].read())
+        if "embeddings" in response_body:
+            return response_body["embeddings"]
+        return [response_body["embedding"]]
+
+    def embed_documents(self, texts:list, on_progress=None) -> list:
+        """
+        Embed a list of texts with concurrent (batched, where supported) requests.
+        If on_progress is provided, it is called from the calling thread with the number of texts embedded so far and the total.
+        """
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        futures = {embeddings_executor.submit(self.invoke, batch): i for i, batch in enumerate(batches)}
+        results = [None] * len(batches)
+        done = 0
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            done += len(batches[i])
+            if on_progress is not None:
+                on_progress(done, len(texts))
+        return [vector for batch in results for vector in batch]
+
+    def embed_query(self, text:str) -> list:
+        """Embed a query text"""
+        return self.invoke([text], input_type="search_query")[0]
+
+
+# Create bedrock_embeddings instance for the configured Bedrock embedding model, backed by the embedding cache
+EMBEDDINGS_MODEL_ID = os.environ.get("BEDROCK_EMBEDDINGS_MODEL_ID", "amazon.titan-embed-text-v1")
+bedrock_embeddings = CachedEmbeddings(BedrockBatchEmbeddings(EMBEDDINGS_MODEL_ID))
+
+
+# Response cache for FM invocations - an in-memory LRU tier in front of an on-disk SQLite tier
+FM_CACHE_ENABLED = os.environ.get("FM_CACHE_ENABLED", "true").lower() == "true"
+FM_CACHE_TTL = int(os.environ.get("FM_CACHE_TTL", "3600"))
+FM_CACHE_MEMORY_SIZE = int(os.environ.get("FM_CACHE_MEMORY_SIZE", "256"))
+FM_CACHE_DISK_SIZE = int(os.environ.get("FM_CACHE_DISK_SIZE", "10000"))
+FM_CACHE_DB = CACHE_DIR.joinpath('', 'fm_responses.db')
+fm_cache_memory = OrderedDict()
+fm_cache_lock = threading.Lock()
+fm_cache_db = sqlite3.connect(FM_CACHE_DB, check_same_thread=False)
+fm_cache_db.execute("""CREATE TABLE IF NOT EXISTS fm_responses (
+    key TEXT PRIMARY KEY, response TEXT, input_tokens INTEGER, output_tokens INTEGER, created_at REAL, accessed_at REAL)""")
+# Expired and least recently used entries are evicted on every put
+fm_cache_db.execute("CREATE INDEX IF NOT EXISTS fm_responses_created_at ON fm_responses (created_at)")
+fm_cache_db.execute("CREATE INDEX IF NOT EXISTS fm_responses_accessed_at ON fm_responses (accessed_at)")
+fm_cache_db.commit()
+# Access times of entries served from the memory tier, written to the disk tier (which evicts the least recently
+# used entries) on the next put, or within FM_CACHE_ACCESS_FLUSH_SECONDS
+FM_CACHE_ACCESS_FLUSH_SECONDS = 30
+fm_cache_accessed = {}
+fm_cache_flushed_at = time.time()
+
+
+def fm_cache_key(modelid:str, body:str) -> str:
+    """Cache key for an FM invocation - the model ID and the exact request body (prompt and inference parameters)"""
+    return hashlib.sha256(f"{modelid}\n{body}".encode()).hexdigest()
+
+
+def fm_cache_flush_access_times():
+    """Write the pending access times of entries served from the memory tier to the disk tier (the caller holds the cache lock and commits)"""
+    global fm_cache_flushed_at
+    if fm_cache_accessed:
+        fm_cache_db.executemany("UPDATE fm_responses SET accessed_at = ? WHERE key = ?",
+                                [(accessed_at, key) for key, accessed_at in fm_cache_accessed.items()])
+        fm_cache_accessed.clear()
+    fm_cache_flushed_at = time.time()
+
+
+def fm_cache_get(key:str):
+    """Get a cached FM response (dict with the response and token counts) or None if it is missing or expired"""
+    now = time.time()
+    with fm_cache_lock:
+        entry = fm_cache_memory.get(key)
+        if entry is not None and now - entry["created_at"] < FM_CACHE_TTL:
+            fm_cache_memory.move_to_end(key)
+            fm_cache_accessed[key] = now
+            if now - fm_cache_flushed_at > FM_CACHE_ACCESS_FLUSH_SECONDS:
+                fm_cache_flush_access_times()
+                fm_cache_db.commit()
+            return entry
+        row = fm_cache_db.execute("SELECT response, input_tokens, output_tokens, created_at FROM fm_responses WHERE key = ? AND created_at > ?",
+                                  (key, now - FM_CACHE_TTL)).fetchone()
+        if row is None:
+            fm_cache_memory.pop(key, None)
+            return None
+        fm_cache_db.execute("UPDATE fm_responses SET accessed_at = ? WHERE key = ?", (now, key))
+        fm_cache_db.commit()
+        entry = {"response": row[0], "input_tokens": row[1], "output_tokens": row[2], "created_at": row[3]}
+        fm_cache_memory[key] = entry
+        if len(fm_cache_memory) > FM_CACHE_MEMORY_SIZE:
+            fm_cache_memory.popitem(last=False)
+        return entry
+
+
+def fm_cache_put(key:str, response:str, in_tokens, out_tokens):
+    """Store an FM response in both cache tiers, evicting expired and least recently used entries"""
+    now = time.time()
+    entry = {"response": response, "input_tokens": in_tokens, "output_tokens": out_tokens, "created_at": now}
+    with fm_cache_lock:
+        fm_cache_memory[key] = entry
+        fm_cache_memory.move_to_end(key)
+        if len(fm_cache_memory) > FM_CACHE_MEMORY_SIZE:
+            fm_cache_memory.popitem(last=False)
+        # Record the accesses served from memory before evicting the least recently used entries
+        fm_cache_flush_access_times()
+        fm_cache_db.execute("INSERT OR REPLACE INTO fm_responses VALUES (?, ?, ?, ?, ?, ?)", (key, response, in_tokens, out_tokens, now, now))
+        fm_cache_db.execute("DELETE FROM fm_responses WHERE created_at <= ?", (now - FM_CACHE_TTL,))
+        fm_cache_db.execute("""DELETE FROM fm_responses WHERE key IN (
+            SELECT key FROM fm_responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""", (FM_CACHE_DISK_SIZE,))
+        fm_cache_db.commit()
+
+
+def token_summary(usage:dict) -> str:
+    """HTML summary of the token usage of an FM response - cache hits are shown instead of (not re-billed) tokens"""
+    if usage.get("cache_hit"):
+        return "<b>Cache hit</b> - no tokens billed"
+    in_tokens = usage["input_tokens"] if usage["input_tokens"] is not None else "Not provided"
+    out_tokens = usage["output_tokens"] if usage["output_tokens"] is not None else "Not provided"
+    summary = f"<b>Input Tokens:</b> {in_tokens} | <b>Output Tokens:</b> {out_tokens}"
+    if usage.get("latency_ms") is not None:
+        summary += f" | <b>Latency:</b> {usage['latency_ms']} ms"
+    return summary
+
+
+# Default maximum number of tokens generated by an FM (callers may pass max_tokens to tune it)
+FM_MAX_TOKENS = int(os.environ.get("FM_MAX_TOKENS", "1024"))
+# Bedrock API used to invoke FMs unless a caller selects one: "invoke_model" (provider-specific request bodies) or
+# "converse" (the same request for all FMs, with token counts and latency reported for all FMs)
+FM_BACKENDS = ("invoke_model", "converse")
+FM_BACKEND = os.environ.get("FM_BACKEND", "invoke_model")
+# Common inference parameter names mapped to the fields of the Converse API's inference configuration
+CONVERSE_PARAMETER_FIELDS = {"max_tokens": "maxTokens", "temperature": "temperature", "top_p": "topP", "stop_sequences": "stopSequences"}
+
+
+class FMAdapter(ABC):
+    """
+    Request building, response parsing, stream decoding and token accounting for a family of Bedrock FMs.
+    Callers pass inference parameters with common names (max_tokens, temperature, top_p, stop_sequences), which
+    are mapped to the names of the provider's request fields - parameters without a field are ignored.
+    """
+
+    # Common inference parameter names mapped to the provider's request fields
+    parameter_fields = {"max_tokens": "max_tokens", "temperature": "temperature", "top_p": "p", "stop_sequences": "stop_sequences"}
+    # Whether the FMs support invoke_model_with_response_stream
+    streaming = True
+
+    @abstractmethod
+    def body(self, prompt:str, params:dict) -> dict:
+        """Request body with the prompt and inference parameters"""
+
+    def parameters(self, params:dict) -> dict:
+        """Inference parameters (with the default max tokens) mapped to the provider's request fields"""
+        params = {"max_tokens": FM_MAX_TOKENS, **(params or {})}
+        return {self.parameter_fields[name]: value for name, value in params.items() if name in self.parameter_fields}
+
+    @abstractmethod
+    def parse(self, response:dict) -> tuple:
+        """Response text, input tokens and output tokens of a decoded response body (token counts may be None)"""
+
+    def stream_text(self, chunk:dict) -> str:
+        """Text delta of a decoded response stream chunk"""
+        return ""
+
+
+class AI21Jurassic2Adapter(FMAdapter):
+    parameter_fields = {"max_tokens": "maxTokens", "temperature": "temperature", "top_p": "topP", "stop_sequences": "stopSequences"}
+    # Jurassic-2 models do not support response streaming
+    streaming = False
+
+    def body(self, prompt:str, params:dict) -> dict:
+        return {"prompt": prompt, **self.parameters(params)}
+
+    def parse(self, response:dict) -> tuple:
+        return response["completions"][0]["data"]["text"], len(response["prompt"]["tokens"]), len(response["completions"][0]["data"]["tokens"])
+
+
+class AnthropicClaudeAdapter(FMAdapter):
+    parameter_fields = {"max_tokens": "max_tokens", "temperature": "temperature", "top_p": "top_p", "stop_sequences": "stop_sequences"}
+
+    def body(self, prompt:str, params:dict) -> dict:
+        return {"anthropic_version": "bedrock-2023-05-31", **self.parameters(params),
+                "messages": [{"role": "user", "content": f"{prompt}"}]}
+
+    def parse(self, response:dict) -> tuple:
+        return response['content'][0]['text'], response['usage']['input_tokens'], response['usage']['output_tokens']
+
+    def stream_text(self, chunk:dict) -> str:
+        return chunk["delta"].get("text", "") if chunk.get("type") == "content_block_delta" else ""
+
+
+class CohereCommandRAdapter(FMAdapter):
+    def body(self, prompt:str, params:dict) -> dict:
+        return {"message": prompt, **self.parameters(params)}
+
+    def parse(self, response:dict) -> tuple:
+        billed = response.get("meta", {}).get("billed_units", {})
+        return response["text"], billed.get("input_tokens"), billed.get("output_tokens")
+
+    def stream_text(self, chunk:dict) -> str:
+        return chunk.get("text", "") if chunk.get("event_type") == "text-generation" else ""
+
+
+class CohereCommandAdapter(FMAdapter):
+    def body(self, prompt:str, params:dict) -> dict:
+        return {"prompt": prompt, **self.parameters(params)}
+
+    def parse(self, response:dict) -> tuple:
+        return response['generations'][0]['text'], None, None
+
+    def stream_text(self, chunk:dict) -> str:
+        if "generations" in chunk:
+            return chunk["generations"][0].get("text", "")
+        return chunk.get("text", "")
+
+
+class MetaLlamaAdapter(FMAdapter):
+    parameter_fields = {"max_tokens": "max_gen_len", "temperature": "temperature", "top_p": "top_p"}
+
+    def body(self, prompt:str, params:dict) -> dict:
+        return {"prompt": prompt, **self.parameters(params)}
+
+    def parse(self, response:dict) -> tuple:
+        return response["generation"], response['prompt_token_count'], response['generation_token_count']
+
+    def stream_text(self, chunk:dict) -> str:
+        return chunk.get("generation", "")
+
+
+class MistralAdapter(FMAdapter):
+    parameter_fields = {"max_tokens": "max_tokens", "temperature": "temperature", "top_p": "top_p", "stop_sequences": "stop"}
+
+    def body(self, prompt:str, params:dict) -> dict:
+        return {"prompt": f"""<s>[INST] {prompt} [/INST]""", **self.parameters(params)}
+
+    def parse(self, response:dict) -> tuple:
+        return response['outputs'][0]['text'], None, None
+
+    def stream_text(self, chunk:dict) -> str:
+        return chunk["outputs"][0].get("text", "") if chunk.get("outputs") else ""
+
+
+class AmazonTitanAdapter(FMAdapter):
+    parameter_fields = {"max_tokens": "maxTokenCount", "temperature": "temperature", "top_p": "topP", "stop_sequences": "stopSequences"}
+
+    def body(self, prompt:str, params:dict) -> dict:
+        return {"inputText": prompt, "textGenerationConfig": self.parameters(params)}
+
+    def parse(self, response:dict) -> tuple:
+        return response["results"][0]["outputText"], response["inputTextTokenCount"], response["results"][0]["tokenCount"]
+
+    def stream_text(self, chunk:dict) -> str:
+        return chunk.get("outputText", "")
+
+
+# FM adapters, matched in order against model IDs
+FM_ADAPTERS = [
+    ("ai21.j2", AI21Jurassic2Adapter()),
+    ("anthropic.claude", AnthropicClaudeAdapter()),
+    ("cohere.command-r", CohereCommandRAdapter()),
+    ("cohere.command-text", CohereCommandAdapter()),
+    ("cohere.command-light", CohereCommandAdapter()),
+    ("meta", MetaLlamaAdapter()),
+    ("mistral", MistralAdapter()),
+    ("amazon", AmazonTitanAdapter()),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def get_fm_adapter(modelid:str):
+    """Get the adapter for an FM (memoised per model ID), or None if the FM is not supported"""
+    return next((adapter for pattern, adapter in FM_ADAPTERS if pattern in modelid), None)
+
+
+def fm_request_body(modelid:str, prompt:str, params:dict = None):
+    """Build the JSON request body for a specific FM with the prompt and inference parameters - returns None for unsupported models"""
+    adapter = get_fm_adapter(modelid)
+    return json.dumps(adapter.body(prompt, params)) if adapter is not None else None
+
+
+def converse_request(prompt:str, params:dict = None) -> dict:
+    """Arguments of a Converse (or ConverseStream) request with the prompt and inference parameters"""
+    params = {"max_tokens": FM_MAX_TOKENS, **(params or {})}
+    return {"messages": [{"role": "user", "content": [{"text": prompt}]}],
+            "inferenceConfig": {CONVERSE_PARAMETER_FIELDS[name]: value for name, value in params.items() if name in CONVERSE_PARAMETER_FIELDS}}
+
+
+def fm_request(modelid:str, prompt:str, params:dict, backend:str):
+    """Backend and request body of an FM invocation (the body is also the response cache key) - the body is None for unsupported models"""
+    backend = backend or FM_BACKEND
+    if backend not in FM_BACKENDS:
+        raise ValueError(f"Unsupported FM backend {backend}. Supported backends: {', '.join(FM_BACKENDS)}")
+    if backend == "converse":
+        return backend, json.dumps({"converse": converse_request(prompt, params)})
+    return backend, fm_request_body(modelid, prompt, params)
+
+
+def ask_fm(modelid:str, prompt:str, use_cache:bool = FM_CACHE_ENABLED, params:dict = None, backend:str = None) -> str:
+    """
+    Invoke specific FM using boto3 and pass the prompt and inference parameters (max tokens defaults to FM_MAX_TOKENS,
+    all other inference parameters will use default values unless provided). The backend is "invoke_model" or
+    "converse" (defaults to FM_BACKEND). Returns the response text and the input and output token counts.
+    """
+    response, usage = ask_fm_usage(modelid, prompt, use_cache=use_cache, params=params, backend=backend)
+    return response, usage["input_tokens"], usage["output_tokens"]
+
+
+def ask_fm_usage(modelid:str, prompt:str, use_cache:bool = FM_CACHE_ENABLED, params:dict = None, backend:str = None) -> tuple:
+    """
+    Invoke specific FM like ask_fm, and return the response text and a usage dict like ask_fm_stream's: the input and
+    output token counts, the latency reported by Bedrock (Converse backend only) and whether the response was cached.
+    """
+    usage = {"input_tokens": None, "output_tokens": None, "latency_ms": None, "cache_hit": False}
+    backend, body = fm_request(modelid, prompt, params, backend)
+    if body is None:
+        return f"Unsupported model. This application's code must be modified for inferencing with {modelid}", usage
+    if use_cache:
+        key = fm_cache_key(modelid, body)
+        cached = fm_cache_get(key)
+        if cached is not None:
+            usage.update(input_tokens=cached["input_tokens"], output_tokens=cached["output_tokens"], cache_hit=True)
+            return cached["response"], usage
+    if backend == "converse":
+        response, usage["input_tokens"], usage["output_tokens"], usage["latency_ms"] = converse_fm(modelid, body)
+    else:
+        response, usage["input_tokens"], usage["output_tokens"] = invoke_fm(modelid, body)
+    if use_cache:
+        fm_cache_put(key, response, usage["input_tokens"], usage["output_tokens"])
+    return response, usage
+
+
+def invoke_fm(modelid:str, body:str):
+    """Invoke specific FM with a request body and parse the response text and token counts"""
     accept = "application/json"
     contentType = "application/json"
-    if "ai21.j2" in modelid:
-        body = json.dumps(
-            {
-                "prompt": prompt,
-                "maxTokens": 1024
-            }
-        )
-    elif "anthropic.claude" in modelid:
-        body=json.dumps(
-            {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 1024,
-                "messages": [{"role": "user", "content": f"{prompt}"}]
-            }
-        )
-    elif "cohere.command-r" in modelid:
-        body = json.dumps(
-            {
-                "message": prompt,
-                "max_tokens": 1024
-            }
-        )
-    elif "cohere.command-text" in modelid or "cohere.command-light" in modelid:
-        body = json.dumps(
-            {
-                "prompt": prompt,
-                "max_tokens": 1024
-            }
-        )
-    elif "meta" in modelid:
-        body = json.dumps(
-            {
-                "prompt": prompt,
-                "max_gen_len": 1024
-            }
-        )
-    elif "mistral" in modelid:
-        body = json.dumps(
-            {
-                "prompt": f"""<s>[INST] {prompt} [/INST]""",
-                "max_tokens": 1024
-            }
-        )            
-    elif "amazon" in modelid:
-        body = json.dumps(
-            {
-                "inputText": prompt,
-                "textGenerationConfig": {
-                    "maxTokenCount": 1024
-                    }
-            }
-        )
-    else:
-        unsupported = True
-    
-    if unsupported:
-        return f"Unsupported model. This application's code must be modified for inferencing with {modelid}", None, None
-    else:
-        # Invoke FM
+    # Invoke FM
+    with fm_semaphore:
         response = bedrock_runtime.invoke_model(body=body, modelId=modelid, accept=accept, contentType=contentType)
-        # Parse and print output
         response_body = json.loads(response["body"].read())
-        if "ai21.j2" in modelid:
-            return response_body["completions"][0]["data"]["text"], None, None
-        elif "anthropic.claude" in modelid:
-            return response_body['content'][0]['text'], response_body['usage']['input_tokens'], response_body['usage']['output_tokens']
-        elif "cohere.command-r-" in modelid:
-            return response_body["text"], None, None
-        elif "cohere.command-text" in modelid or "cohere.command-light" in modelid:
-            return response_body['generations'][0]['text'], None, None
-        elif "meta" in modelid:
-            return response_body["generation"], response_body['prompt_token_count'], response_body['generation_token_count']
-        elif "amazon" in modelid:
-            return response_body["results"][0]["outputText"], response_body["inputTextTokenCount"], response_body["results"][0]["tokenCount"]
-        elif "mistral" in modelid:
-            return response_body['outputs'][0]['text'], None, None
\ No newline at end of file
+    # Parse output - Bedrock also returns the token counts for all providers in the response headers
+    text, in_tokens, out_tokens = get_fm_adapter(modelid).parse(response_body)
+    headers = response["ResponseMetadata"]["HTTPHeaders"]
+    if in_tokens is None and "x-amzn-bedrock-input-token-count" in headers:
+        in_tokens = int(headers["x-amzn-bedrock-input-token-count"])
+    if out_tokens is None and "x-amzn-bedrock-output-token-count" in headers:
+        out_tokens = int(headers["x-amzn-bedrock-output-token-count"])
+    return text, in_tokens, out_tokens
+
+
+def converse_fm(modelid:str, body:str):
+    """Invoke specific FM with the Converse API and return the response text, token counts and latency (in milliseconds)"""
+    with fm_semaphore:
+        response = bedrock_runtime.converse(modelId=modelid, **json.loads(body)["converse"])
+    text = "".join(block.get("text", "") for block in response["output"]["message"]["content"])
+    return text, response["usage"]["inputTokens"], response["usage"]["outputTokens"], response["metrics"]["latencyMs"]
+
+
+def ask_fm_stream(modelid:str, prompt:str, use_cache:bool = FM_CACHE_ENABLED, params:dict = None, backend:str = None):
+    """
+    Invoke specific FM with response streaming and yield the text deltas as they are generated.
+    The generator returns a dict with the input and output token counts, the latency reported by Bedrock
+    (Converse backend only) and whether the response was served from the response cache once the response is complete.
+    """
+    usage = {"input_tokens": None, "output_tokens": None, "latency_ms": None, "cache_hit": False}
+    accept = "application/json"
+    contentType = "application/json"
+    backend, body = fm_request(modelid, prompt, params, backend)
+    if body is None:
+        yield f"Unsupported model. This application's code must be modified for inferencing with {modelid}"
+        return usage
+    if use_cache:
+        key = fm_cache_key(modelid, body)
+        cached = fm_cache_get(key)
+        if cached is not None:
+            usage.update(input_tokens=cached["input_tokens"], output_tokens=cached["output_tokens"], cache_hit=True)
+            yield cached["response"]
+            return usage
+    adapter = get_fm_adapter(modelid)
+    if adapter is not None and not adapter.streaming:
+        # The complete response is yielded at once
+        if backend == "converse":
+            response, usage["input_tokens"], usage["output_tokens"], usage["latency_ms"] = converse_fm(modelid, body)
+        else:
+            response, usage["input_tokens"], usage["output_tokens"] = invoke_fm(modelid, body)
+        yield response
+    elif backend == "converse":
+        response = ""
+        # The invocation holds a slot of the concurrency cap until the stream is complete or closed
+        with fm_semaphore:
+            stream = bedrock_runtime.converse_stream(modelId=modelid, **json.loads(body)["converse"])["stream"]
+            try:
+                for event in stream:
+                    text = event.get("contentBlockDelta", {}).get("delta", {}).get("text", "")
+                    if text:
+                        response += text
+                        yield text
+                    # The last event has the token counts and latency for all models
+                    metadata = event.get("metadata")
+                    if metadata:
+                        usage["input_tokens"] = metadata["usage"]["inputTokens"]
+                        usage["output_tokens"] = metadata["usage"]["outputTokens"]
+                        usage["latency_ms"] = metadata["metrics"]["latencyMs"]
+            finally:
+                # Close the connection if the stream is abandoned (e.g. cancelled), which stops the generation
+                stream.close()
+    else:
+        response = ""
+        # The invocation holds a slot of the concurrency cap until the stream is complete or closed
+        with fm_semaphore:
+            stream = bedrock_runtime.invoke_model_with_response_stream(body=body, modelId=modelid, accept=accept, contentType=contentType)
+            try:
+                for event in stream["body"]:
+                    chunk = event.get("chunk")
+                    if not chunk:
+                        continue
+                    chunk_body = json.loads(chunk["bytes"])
+                    text = adapter.stream_text(chunk_body)
+                    if text:
+                        response += text
+                        yield text
+                    # Bedrock adds invocation metrics with token counts for all providers to the last chunk
+                    metrics = chunk_body.get("amazon-bedrock-invocationMetrics")
+                    if metrics:
+                        usage["input_tokens"] = metrics.get("inputTokenCount")
+                        usage["output_tokens"] = metrics.get("outputTokenCount")
+            finally:
+                # Close the connection if the stream is abandoned (e.g. cancelled), which stops the generation
+                stream["body"].close()
+    if use_cache:
+        fm_cache_put(key, response, usage["input_tokens"], usage["output_tokens"])
+    return usage
+
+
+def collect_fm_stream(stream, on_text=None):
+    """
+    Consume a response stream from ask_fm_stream and return the complete text and token usage.
+    If on_text is provided, it is called with the text received so far after every delta (e.g. to update a placeholder).
+    If on_text raises (e.g. Streamlit stopping the script for a rerun), the stream is closed.
+    """
+    text = ""
+    try:
+        while True:
+            try:
+                delta = next(stream)
+            except StopIteration as stop:
+                return text, stop.value
+            text += delta
+            if on_text is not None:
+                on_text(text)
+    finally:
+        stream.close()
+
+
+
+async def run_in_fm_pool(fn, *args, **kwargs):
+    """Run a blocking function (e.g. ask_fm) in the shared FM thread pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(fm_executor, functools.partial(fn, *args, **kwargs))
+
+
+class FMStreamCancelled(Exception):
+    """Raised to stop consuming a response stream whose consumer has gone (e.g. a Streamlit rerun)"""
+
+
+def fan_out_fm_streams(jobs:dict, max_concurrency:int = None, backend:str = None):
+    """
+    Stream several FM responses concurrently in the shared FM thread pool and yield their events as they arrive.
+    jobs maps a key (e.g. a model ID) to a (modelid, prompt) or (modelid, prompt, params) tuple, where params are the
+    inference parameters passed to ask_fm_stream (with the backend). If max_concurrency is provided, at most that many
+    jobs run at a time (in the order of jobs), leaving the rest of the pool to other sessions. Events are yielded as (key, event_type, payload):
+    ("text", text received so far) for every delta, ("done", metrics) when a response is complete and ("error", message)
+    if the invocation fails. Metrics include the response text, token usage, latency (and the latency reported by Bedrock), time to first token and tokens/sec
+    (None for cached responses).
+    If the generator is closed before all responses are complete (e.g. by a Streamlit rerun), the streams still running
+    are closed at their next delta and the jobs not started are skipped.
+    """
+    events = queue.Queue()
+    stop = threading.Event()
+
+    def run_stream(key, modelid:str, prompt:str, params:dict = None):
+        """Consume one response stream in a worker thread and publish its events"""
+        start = time.perf_counter()
+        first_token = None
+
+        def on_text(text:str):
+            nonlocal first_token
+            if stop.is_set():
+                # collect_fm_stream closes the stream, which stops the generation
+                raise FMStreamCancelled()
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            events.put((key, "text", text))
+
+        if stop.is_set():
+            return
+        try:
+            text, usage = collect_fm_stream(ask_fm_stream(modelid, prompt, params=params, backend=backend), on_text=on_text)
+        except FMStreamCancelled:
+            return
+        except Exception as e:
+            events.put((key, "error", str(e)))
+            return
+        latency = time.perf_counter() - start
+        out_tokens = usage["output_tokens"]
+        generation_time = latency - (first_token or 0)
+        # A cached response is not generated, so it has no generation rate
+        generating = out_tokens and generation_time > 0 and not usage["cache_hit"]
+        events.put((key, "done", {
+            "text": text,
+            "model_id": modelid,
+            "usage": usage,
+            "input_tokens": usage["input_tokens"],
+            "output_tokens": out_tokens,
+            "latency": latency,
+            "server_latency": usage["latency_ms"] / 1000 if usage["latency_ms"] is not None else None,
+            "time_to_first_token": first_token,
+            "tokens_per_sec": out_tokens / generation_time if generating else None
+        }))
+
+    pending = iter(jobs.items())
+    for key, job in itertools.islice(pending, max_concurrency):
+        fm_executor.submit(run_stream, key, *job)
+    remaining = len(jobs)
+    try:
+        while remaining:
+            event = events.get()
+            if event[1] in ("done", "error"):
+                remaining -= 1
+                for key, job in itertools.islice(pending, 1):
+                    fm_executor.submit(run_stream, key, *job)
+            yield event
+    finally:
+        stop.set()
+
+
+# Semantic cache of RAG answers - past questions are matched by cosine similarity of their embeddings
+RAG_SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("RAG_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+RAG_SEMANTIC_CACHE_SIZE = int(os.environ.get("RAG_SEMANTIC_CACHE_SIZE", "512"))
+semantic_cache = {"index_version": None, "vectors": {}, "answers": {}}
+semantic_cache_lock = threading.Lock()
+
+
+def semantic_cache_lookup(question_vector:list, modelid:str, index_version:str):
+    """
+    Get the cached answer to the most similar past question for a model, if its similarity exceeds
+    RAG_SEMANTIC_CACHE_THRESHOLD and it was answered against the same version of the vector index.
+    """
+    vector = np.asarray(question_vector, dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    with semantic_cache_lock:
+        if semantic_cache["index_version"] != index_version or modelid not in semantic_cache["vectors"]:
+            return None
+        similarities = semantic_cache["vectors"][modelid] @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < RAG_SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return semantic_cache["answers"][modelid][best]
+
+
+def semantic_cache_add(question_vector:list, modelid:str, index_version:str, answer:dict):
+    """Add an answer to the semantic cache - answers for older versions of the vector index are discarded"""
+    vector = np.asarray(question_vector, dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    with semantic_cache_lock:
+        if semantic_cache["index_version"] != index_version:
+            semantic_cache.update(index_version=index_version, vectors={}, answers={})
+        vectors = semantic_cache["vectors"].get(modelid, np.empty((0, len(vector)), dtype=np.float32))
+        answers = semantic_cache["answers"].get(modelid, [])
+        # Keep the most recent questions only
+        semantic_cache["vectors"][modelid] = np.vstack([vectors, vector])[-RAG_SEMANTIC_CACHE_SIZE:]
+        semantic_cache["answers"][modelid] = (answers + [answer])[-RAG_SEMANTIC_CACHE_SIZE:]
+
+
+# Token-budgeted context for augmented (RAG) prompts
+RAG_CONTEXT_TOKENS = int(os.environ.get("RAG_CONTEXT_TOKENS", "1000"))
+RAG_CONTEXT_CANDIDATES = int(os.environ.get("RAG_CONTEXT_CANDIDATES", "6"))
+# Approximate number of characters per token of each model provider's tokenizer (for English text)
+CHARS_PER_TOKEN = {"anthropic": 3.5, "meta": 3.8, "mistral": 3.5, "amazon": 4.0, "cohere": 4.0, "ai21": 4.0}
+# Chunks sharing this fraction of their word shingles with a chunk already in the context are considered duplicates
+CONTEXT_DUPLICATE_SIMILARITY = 0.8
+CONTEXT_SEPARATOR = "\n\n"
+
+
+def estimate_tokens(modelid:str, text:str) -> int:
+    """Estimate the number of tokens of a text for a model, based on its provider's tokenizer"""
+    provider = next((p for p in modelid.split('.') if p in CHARS_PER_TOKEN), None)
+    return math.ceil(len(text) / CHARS_PER_TOKEN.get(provider, 4.0))
+
+
+def shingles(text:str) -> set:
+    """Word 3-grams of a text, for detecting overlapping chunks"""
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + 3]) for i in range(max(len(words) - 2, 1))}
+
+
+def build_context(modelid:str, chunks:list, budget:int = RAG_CONTEXT_TOKENS) -> dict:
+    """
+    Pack retrieved chunks (best first) into a context of at most budget tokens (estimated for the model), skipping
+    chunks that duplicate or overlap chunks already packed and chunks that do not fit. The first chunk is truncated
+    if it does not fit on its own. Returns the context, the indexes of the chunks packed and the tokens used.
+    """
+    packed, packed_shingles, used, duplicates = [], [], 0, 0
+    separator_tokens = estimate_tokens(modelid, CONTEXT_SEPARATOR)
+    for i, chunk in enumerate(chunks):
+        text = chunk.strip()
+        chunk_shingles = shingles(text)
+        if not text or any(len(chunk_shingles & s) >= CONTEXT_DUPLICATE_SIMILARITY * min(len(chunk_shingles), len(s))
+                           for s in packed_shingles):
+            duplicates += 1
+            continue
+        tokens = estimate_tokens(modelid, text) + (separator_tokens if packed else 0)
+        if used + tokens > budget:
+            if packed:
+                continue
+            text = text[:int(budget * len(text) / tokens)]
+            tokens = estimate_tokens(modelid, text)
+        packed.append((i, text))
+        packed_shingles.append(chunk_shingles)
+        used += tokens
+    return {"context": CONTEXT_SEPARATOR.join(text for _, text in packed), "chunks": [i for i, _ in packed],
+            "retrieved": len(chunks), "duplicates": duplicates, "tokens": used, "budget": budget}
+
+
+class BedrockFM(LLM):
+    """
+    LangChain LLM for a Bedrock FM, invoked (with the FM response cache) through ask_fm_usage and ask_fm_stream.
+    Inference parameters are taken from params, overridden by the keyword arguments of each call (e.g. predict).
+    The generation info of each generation (e.g. from generate) is the usage of its invocation, with the latency
+    reported by Bedrock when the Converse backend is used.
+    """
+
+    model_id: str
+    params: dict = {}
+    backend: str = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "bedrock-fm"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model_id": self.model_id, "params": self.params, "backend": self.backend}
+
+    def inference_params(self, stop, kwargs:dict) -> dict:
+        """Inference parameters of a call"""
+        params = {**self.params, **kwargs}
+        if stop:
+            params["stop_sequences"] = stop
+        return params
+
+    def _call(self, prompt:str, stop=None, run_manager=None, **kwargs) -> str:
+        return ask_fm_usage(self.model_id, prompt, params=self.inference_params(stop, kwargs), backend=self.backend)[0]
+
+    def _generate(self, prompts:list, stop=None, run_manager=None, **kwargs) -> LLMResult:
+        generations = []
+        for prompt in prompts:
+            text, usage = ask_fm_usage(self.model_id, prompt, params=self.inference_params(stop, kwargs), backend=self.backend)
+            generations.append([Generation(text=text, generation_info=usage)])
+        return LLMResult(generations=generations)
+
+    def _stream(self, prompt:str, stop=None, run_manager=None, **kwargs):
+        for text in ask_fm_stream(self.model_id, prompt, params=self.inference_params(stop, kwargs), backend=self.backend):
+            chunk = GenerationChunk(text=text)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    def get_num_tokens(self, text:str) -> int:
+        return estimate_tokens(self.model_id, text)
+
+
+# LangChain LLMs are memoised per model ID
+fms = {}
+fms_lock = threading.Lock()
+
+
+def get_fm(modelid:str) -> BedrockFM:
+    """Get the LangChain LLM for a Bedrock FM"""
+    with fms_lock:
+        if modelid not in fms:
+            fms[modelid] = BedrockFM(model_id=modelid)
+        return fms[modelid]
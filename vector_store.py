@@ -0,0 +1,677 @@
+import os
+import re
+import json
+import math
+import hashlib
+import functools
+import threading
+import contextlib
+from collections import Counter, OrderedDict
+import numpy as np
+import faiss
+from langchain.schema import Document
+try:
+    import fcntl
+except ImportError:
+    # Windows - file locks are not available, so a single process must write the index
+    fcntl = None
+
+
+# Number of appended segments after which the index is consolidated into a snapshot
+SNAPSHOT_SEGMENTS = int(os.environ.get("VECTOR_STORE_SNAPSHOT_SEGMENTS", "10"))
+# FAISS index type (flat, ivf_flat, hnsw, ivf_pq) or auto to choose one based on the number of chunks
+VECTOR_INDEX_TYPE = os.environ.get("VECTOR_INDEX_TYPE", "auto")
+VECTOR_INDEX_NPROBE = int(os.environ.get("VECTOR_INDEX_NPROBE", "16"))
+VECTOR_INDEX_EF_SEARCH = int(os.environ.get("VECTOR_INDEX_EF_SEARCH", "64"))
+HNSW_M = 32
+# Minimum number of chunks for training each index type (IVF needs ~39 points per list, PQ 256 per centroid)
+MIN_TRAINING_SIZE = {"flat": 0, "hnsw": 0, "ivf_flat": 10000, "ivf_pq": 50000}
+# Retrain IVF indexes when the corpus has grown by this factor since they were trained
+RETRAIN_GROWTH = 4
+# Rewrite the snapshot when this fraction of its chunks has been deleted
+COMPACT_DELETED_FRACTION = 0.1
+# Number of vectors read, written or added to an index at a time
+BLOCK_SIZE = 65536
+MANIFEST_FILE = "manifest.json"
+# Lock file held by the process changing (or reloading) the index
+LOCK_FILE = "index.lock"
+# Version of the on-disk format - directories in another format (e.g. written by LangChain's FAISS.save_local
+# in earlier versions of this application) are cleared and rebuilt from the documents
+STORE_FORMAT = 3
+# Combine the vector search results with the results of a lexical (BM25) search with reciprocal rank fusion
+HYBRID_SEARCH = os.environ.get("VECTOR_STORE_HYBRID_SEARCH", "true").lower() == "true"
+# Number of results of each search that are fused
+HYBRID_SEARCH_CANDIDATES = int(os.environ.get("VECTOR_STORE_HYBRID_SEARCH_CANDIDATES", "20"))
+RRF_K = 60
+BM25_K1 = 1.2
+BM25_B = 0.75
+TERM_PATTERN = re.compile(r"\w+")
+# Number of sentence indexes (one per text) kept resident
+SENTENCE_INDEX_CACHE_SIZE = int(os.environ.get("SENTENCE_INDEX_CACHE_SIZE", "32"))
+# Open snapshot indexes read-only and memory-mapped where the FAISS version supports it for the index type: the
+# inverted lists of IVF indexes are mapped, and IO_FLAG_MMAP_IFC (not in faiss-cpu 1.8.0) also maps flat indexes
+MMAP_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+
+@functools.lru_cache(maxsize=65536)
+def term_hash(term:str) -> int:
+    """Stable 64-bit hash of a term - the inverted index stores term hashes rather than a vocabulary"""
+    return int.from_bytes(hashlib.blake2b(term.encode(), digest_size=8).digest(), "little", signed=True)
+
+
+def term_frequencies(text:str) -> Counter:
+    """Frequencies of the terms (lowercased words) of a text, keyed by term hash"""
+    return Counter(term_hash(term) for term in TERM_PATTERN.findall(text.lower()))
+
+
+def choose_index_type(n:int) -> str:
+    """
+    Choose the FAISS index type for a number of chunks: exact search for small corpora, IVF-Flat for
+    medium corpora and IVF-PQ (compressed vectors, bounded RAM) for millions of chunks.
+    """
+    index_type = VECTOR_INDEX_TYPE
+    if index_type == "auto":
+        index_type = "flat" if n < 20000 else "ivf_flat" if n < 1000000 else "ivf_pq"
+    # Use exact search until there are enough chunks to train the index
+    return index_type if n >= MIN_TRAINING_SIZE[index_type] else "flat"
+
+
+def pq_subquantizers(dim:int) -> int:
+    """Number of PQ sub-quantizers - the largest divisor of the dimension up to 64 (e.g. 64 for 1536 dimensions)"""
+    return max(m for m in range(1, 65) if dim % m == 0)
+
+
+def build_index(index_type:str, ids, vectors):
+    """Create, train and fill a FAISS index of a type with vectors and their chunk IDs"""
+    dim = vectors.shape[1]
+    if index_type == "flat":
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+    elif index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dim, HNSW_M)
+        hnsw.hnsw.efConstruction = 80
+        index = faiss.IndexIDMap2(hnsw)
+    else:
+        # IVF indexes store chunk IDs natively (and support removing them), so they are not wrapped in an ID map
+        nlist = max(1, min(int(4 * np.sqrt(len(vectors))), len(vectors) // 39))
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_subquantizers(dim), 8)
+        # Train on a sample of the vectors
+        sample = np.sort(np.random.default_rng(0).permutation(len(vectors))[:256 * nlist])
+        index.train(np.asarray(vectors[sample]))
+    # Add the vectors in blocks, so memory-mapped vectors are never loaded at once
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        index.add_with_ids(np.asarray(vectors[start:start + BLOCK_SIZE]), np.asarray(ids[start:start + BLOCK_SIZE]))
+    tune_index(index)
+    return index
+
+
+def tune_index(index):
+    """Apply the search-time parameters (nprobe for IVF, efSearch for HNSW) to an index"""
+    sub_index = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(sub_index, faiss.IndexHNSW):
+        sub_index.hnsw.efSearch = VECTOR_INDEX_EF_SEARCH
+    elif isinstance(sub_index, faiss.IndexIVF):
+        sub_index.nprobe = VECTOR_INDEX_NPROBE
+
+
+class DocumentIndex:
+    """
+    FAISS index of document chunks that is persisted incrementally and shared by all sessions (and processes).
+    The bulk of the index is an immutable snapshot whose raw vectors and chunk store (texts and metadata in a binary
+    file, with offsets, IDs and sources in NumPy arrays) are memory-mapped read-only, so that all readers share the
+    same physical pages. The snapshot's FAISS index is memory-mapped only where the FAISS version supports it: with
+    faiss-cpu 1.8.0, the inverted lists of IVF indexes are mapped, but flat and HNSW indexes are read into the memory
+    of each process.
+    Every ingest is appended as a segment (vectors and chunks of the new documents only) that is held in a small
+    in-memory index until the segments are consolidated into a new snapshot, so the cost of an ingest scales with
+    the new data rather than the whole corpus. Chunks deleted from the snapshot are filtered out of the search
+    results until the next snapshot.
+    Alongside the vectors, an inverted index of the chunks' terms (for BM25 search) is kept the same way: the
+    snapshot's postings are memory-mapped NumPy arrays, and the postings of the segments are held in memory and
+    merged into the next snapshot without tokenizing the snapshot's chunks again.
+    The manifest records the snapshot, the segments since the snapshot and the chunk IDs deleted since the snapshot.
+    As the corpus grows, the snapshot index is rebuilt (and trained) as another type from its raw vectors.
+    Processes change (and reload) the index one at a time, holding an exclusive lock on the lock file, and reload it
+    before a change if another process has changed it. Without file locks (Windows), a single process must change it.
+    """
+
+    def __init__(self, db_dir:str):
+        self.db_dir = db_dir
+        self.lock = threading.RLock()
+        self.lock_file = open(self.path(LOCK_FILE), mode='a')
+        self.lock_depth = 0
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self.base_ids) - len(self.base_deleted) + len(self.delta_chunks)
+
+    @property
+    def version(self) -> int:
+        """Version of the index, incremented on every change"""
+        with self.lock:
+            self.reload_if_changed()
+            return self.manifest["version"]
+
+    def path(self, name:str) -> str:
+        """Path of a file in the index directory"""
+        return os.path.join(self.db_dir, name)
+
+    @contextlib.contextmanager
+    def locked(self, reload:bool = True):
+        """
+        Hold the thread lock and (in the outermost call of a thread) the lock file, reloading the index first if
+        another process has changed it, so that the changes of processes are not interleaved.
+        """
+        with self.lock:
+            outermost = self.lock_depth == 0
+            if outermost and fcntl is not None:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                if outermost and reload:
+                    self.reload_if_changed()
+                yield
+            finally:
+                self.lock_depth -= 1
+                if outermost and fcntl is not None:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def manifest_mtime(self):
+        """Modification time of the manifest file, or None if it does not exist"""
+        return os.stat(self.path(MANIFEST_FILE)).st_mtime_ns if os.path.exists(self.path(MANIFEST_FILE)) else None
+
+    def load(self):
+        """Open the snapshot and replay the segments and deletions recorded in the manifest"""
+        with self.locked(reload=False):
+            self.open_snapshot(None)
+            self.delta_index = None
+            self.delta_chunks = {}
+            self.delta_terms = {}
+            self.delta_postings = {}
+            self.delta_lengths = {}
+            self.delta_length = 0
+            manifest = None
+            if os.path.exists(self.path(MANIFEST_FILE)):
+                with open(self.path(MANIFEST_FILE)) as r:
+                    manifest = json.load(r)
+            if manifest is None or manifest.get("format") != STORE_FORMAT:
+                for f in os.listdir(self.db_dir):
+                    if f != LOCK_FILE:
+                        os.remove(self.path(f))
+                self.manifest = {"format": STORE_FORMAT, "version": manifest["version"] if manifest else 0, "dim": None, "next_id": 0,
+                                 "snapshot": None, "segments": [], "deleted": [], "index_type": "flat", "trained_size": 0}
+                self.mtime = None
+                return
+            self.manifest = manifest
+            self.mtime = self.manifest_mtime()
+            if self.manifest["snapshot"]:
+                self.open_snapshot(self.manifest["snapshot"])
+            if self.manifest["dim"] is not None:
+                self.delta_index = build_index("flat", [], np.empty((0, self.manifest["dim"]), dtype=np.float32))
+            for segment in self.manifest["segments"]:
+                data = np.load(self.path(f"{segment}.npz"))
+                self.delta_index.add_with_ids(data["vectors"], data["ids"])
+                with open(self.path(f"{segment}.jsonl")) as r:
+                    for line in r:
+                        chunk = json.loads(line)
+                        self.delta_chunks[chunk["id"]] = chunk
+                        self.index_terms(chunk)
+            self.forget(self.manifest["deleted"])
+
+    def reload_if_changed(self):
+        """Reload the index if another process has changed it (the file lock is only taken to reload)"""
+        if self.manifest_mtime() != self.mtime:
+            self.load()
+
+    def open_snapshot(self, name):
+        """Memory-map the FAISS index, raw vectors and chunk store of a snapshot (or reset them if name is None)"""
+        self.base_index = None
+        self.base_ids = np.empty(0, dtype=np.int64)
+        self.base_vectors = None
+        self.base_deleted = set()
+        self.deleted_filters = None
+        self.base_terms = np.empty(0, dtype=np.int64)
+        self.base_term_offsets = np.zeros(1, dtype=np.int64)
+        self.base_postings = np.empty(0, dtype=np.int32)
+        self.base_term_counts = np.empty(0, dtype=np.uint16)
+        self.base_lengths = np.empty(0, dtype=np.int32)
+        self.base_length = 0
+        if name is None:
+            return
+        try:
+            self.base_index = faiss.read_index(self.path(f"{name}.faiss"), MMAP_FLAGS)
+        except RuntimeError:
+            # This index type cannot be memory-mapped by the installed FAISS version
+            self.base_index = faiss.read_index(self.path(f"{name}.faiss"))
+        tune_index(self.base_index)
+        self.base_ids = np.load(self.path(f"{name}.ids.npy"), mmap_mode='r')
+        self.base_vectors = np.load(self.path(f"{name}.vectors.npy"), mmap_mode='r')
+        self.base_offsets = np.load(self.path(f"{name}.offsets.npy"), mmap_mode='r')
+        self.base_sources = np.load(self.path(f"{name}.sources.npy"), mmap_mode='r')
+        with open(self.path(f"{name}.sources.json")) as r:
+            self.base_source_names = json.load(r)
+        self.base_chunks = np.memmap(self.path(f"{name}.chunks.bin"), dtype=np.uint8, mode='r') if len(self.base_ids) else None
+        # Inverted index: sorted term hashes, the offsets of each term's postings, and for each posting the position
+        # of the chunk in the snapshot and the term's frequency in the chunk. Lengths are the chunks' numbers of terms.
+        for array in ("terms", "term_offsets", "postings", "term_counts", "lengths"):
+            setattr(self, f"base_{array}", np.load(self.path(f"{name}.{array}.npy"), mmap_mode='r'))
+        self.base_length = int(np.sum(self.base_lengths))
+
+    def index_terms(self, chunk:dict):
+        """Add the terms of a chunk held in memory to the inverted index"""
+        frequencies = term_frequencies(chunk["text"])
+        self.delta_terms[chunk["id"]] = frequencies
+        self.delta_lengths[chunk["id"]] = sum(frequencies.values())
+        self.delta_length += self.delta_lengths[chunk["id"]]
+        for term, count in frequencies.items():
+            self.delta_postings.setdefault(term, {})[chunk["id"]] = count
+
+    def forget(self, ids:list):
+        """Remove deleted chunk IDs from the in-memory index and mark those in the snapshot as deleted"""
+        delta_ids = [chunk_id for chunk_id in ids if chunk_id in self.delta_chunks]
+        if delta_ids:
+            self.delta_index.remove_ids(np.asarray(delta_ids, dtype=np.int64))
+            for chunk_id in delta_ids:
+                del self.delta_chunks[chunk_id]
+                self.delta_length -= self.delta_lengths.pop(chunk_id)
+                for term in self.delta_terms.pop(chunk_id):
+                    postings = self.delta_postings[term]
+                    del postings[chunk_id]
+                    if not postings:
+                        del self.delta_postings[term]
+        self.base_deleted.update(chunk_id for chunk_id in ids if chunk_id not in delta_ids)
+        self.deleted_filters = None
+
+    def get_deleted_filters(self) -> dict:
+        """
+        Filters that exclude the chunks deleted from the snapshot inside the searches (built once per deletion): FAISS
+        search parameters with a selector of the IDs not deleted, and a mask of the deleted positions in the snapshot.
+        """
+        if self.deleted_filters is None:
+            deleted = np.fromiter(sorted(self.base_deleted), dtype=np.int64, count=len(self.base_deleted))
+            batch = faiss.IDSelectorBatch(len(deleted), faiss.swig_ptr(deleted))
+            selector = faiss.IDSelectorNot(batch)
+            sub_index = faiss.downcast_index(self.base_index.index) if isinstance(self.base_index, faiss.IndexIDMap2) else self.base_index
+            # Search parameters replace the index's search-time parameters, so those are set again
+            if isinstance(sub_index, faiss.IndexHNSW):
+                params = faiss.SearchParametersHNSW(sel=selector, efSearch=VECTOR_INDEX_EF_SEARCH)
+            elif isinstance(sub_index, faiss.IndexIVF):
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=VECTOR_INDEX_NPROBE)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+            # The search parameters do not own the selectors, so they are kept with them
+            self.deleted_filters = {"params": params, "selectors": (selector, batch),
+                                    "mask": np.isin(self.base_ids, deleted)}
+        return self.deleted_filters
+
+    def base_chunk(self, position:int) -> dict:
+        """Read a chunk from the memory-mapped chunk store of the snapshot"""
+        start, text_end, end = self.base_offsets[position]
+        return {"id": int(self.base_ids[position]),
+                "text": self.base_chunks[start:text_end].tobytes().decode(),
+                "metadata": json.loads(self.base_chunks[text_end:end].tobytes())}
+
+    def chunk(self, chunk_id:int):
+        """Get a chunk by ID, or None if it does not exist or has been deleted"""
+        if chunk_id in self.delta_chunks:
+            return self.delta_chunks[chunk_id]
+        if chunk_id in self.base_deleted:
+            return None
+        position = int(np.searchsorted(self.base_ids, chunk_id))
+        if position < len(self.base_ids) and self.base_ids[position] == chunk_id:
+            return self.base_chunk(position)
+        return None
+
+    def write_manifest(self):
+        """Atomically replace the manifest, which commits all files written before it"""
+        self.manifest["version"] += 1
+        tmp_file = self.path(f"{MANIFEST_FILE}.tmp")
+        with open(tmp_file, mode='w') as w:
+            json.dump(self.manifest, w)
+        os.replace(tmp_file, self.path(MANIFEST_FILE))
+        self.mtime = self.manifest_mtime()
+
+    def live_vectors(self):
+        """Yield blocks of IDs and raw vectors of all chunks in ID order, from the snapshot and then the segments"""
+        deleted = np.fromiter(self.base_deleted, dtype=np.int64, count=len(self.base_deleted))
+        for start in range(0, len(self.base_ids), BLOCK_SIZE):
+            ids = np.asarray(self.base_ids[start:start + BLOCK_SIZE])
+            live = ~np.isin(ids, deleted)
+            yield ids[live], np.asarray(self.base_vectors[start:start + BLOCK_SIZE])[live]
+        delta_ids = np.fromiter(self.delta_chunks.keys(), dtype=np.int64, count=len(self.delta_chunks))
+        for segment in self.manifest["segments"]:
+            data = np.load(self.path(f"{segment}.npz"))
+            live = np.isin(data["ids"], delta_ids)
+            yield data["ids"][live], data["vectors"][live]
+
+    def live_chunks(self):
+        """Yield all chunks in ID order, from the snapshot and then the segments"""
+        for position, chunk_id in enumerate(self.base_ids):
+            if int(chunk_id) not in self.base_deleted:
+                yield self.base_chunk(position)
+        for chunk_id in sorted(self.delta_chunks):
+            yield self.delta_chunks[chunk_id]
+
+    def write_snapshot_data(self, name:str):
+        """Write the raw vectors and the chunk store of all chunks for a new snapshot, block by block"""
+        n = len(self)
+        ids_out = np.lib.format.open_memmap(self.path(f"{name}.ids.npy"), mode='w+', dtype=np.int64, shape=(n,))
+        vectors_out = np.lib.format.open_memmap(self.path(f"{name}.vectors.npy"), mode='w+', dtype=np.float32, shape=(n, self.manifest["dim"]))
+        position = 0
+        for ids, vectors in self.live_vectors():
+            ids_out[position:position + len(ids)] = ids
+            vectors_out[position:position + len(ids)] = vectors
+            position += len(ids)
+        ids_out.flush()
+        vectors_out.flush()
+        del ids_out, vectors_out
+        offsets = np.empty((n, 3), dtype=np.int64)
+        sources = np.empty(n, dtype=np.int32)
+        source_names = {}
+        with open(self.path(f"{name}.chunks.bin"), mode='wb') as w:
+            offset = 0
+            for position, chunk in enumerate(self.live_chunks()):
+                text = chunk["text"].encode()
+                metadata = json.dumps(chunk["metadata"]).encode()
+                w.write(text)
+                w.write(metadata)
+                offsets[position] = (offset, offset + len(text), offset + len(text) + len(metadata))
+                offset += len(text) + len(metadata)
+                sources[position] = source_names.setdefault(chunk["metadata"].get("source", ""), len(source_names))
+        np.save(self.path(f"{name}.offsets.npy"), offsets)
+        np.save(self.path(f"{name}.sources.npy"), sources)
+        with open(self.path(f"{name}.sources.json"), mode='w') as w:
+            json.dump(list(source_names), w)
+        self.write_snapshot_terms(name)
+
+    def write_snapshot_terms(self, name:str):
+        """Write the inverted index of all chunks for a new snapshot, merging the snapshot's postings with the segments'"""
+        deleted = np.fromiter(self.base_deleted, dtype=np.int64, count=len(self.base_deleted))
+        live = ~np.isin(self.base_ids, deleted)
+        # Positions of the snapshot's chunks in the new snapshot (chunks are in ID order, snapshot before segments)
+        new_positions = np.cumsum(live) - 1
+        positions = np.asarray(self.base_postings)
+        keep = live[positions]
+        terms = np.repeat(np.asarray(self.base_terms), np.diff(self.base_term_offsets))[keep]
+        counts = np.asarray(self.base_term_counts)[keep]
+        positions = new_positions[positions[keep]]
+        delta_ids = sorted(self.delta_chunks)
+        delta_positions = {chunk_id: int(live.sum()) + i for i, chunk_id in enumerate(delta_ids)}
+        delta = [(term, delta_positions[chunk_id], count) for term, postings in self.delta_postings.items()
+                 for chunk_id, count in postings.items()]
+        if delta:
+            delta_terms, delta_positions, delta_counts = zip(*delta)
+            terms = np.concatenate([terms, np.asarray(delta_terms, dtype=np.int64)])
+            positions = np.concatenate([positions, np.asarray(delta_positions, dtype=np.int64)])
+            counts = np.concatenate([counts, np.minimum(delta_counts, np.iinfo(np.uint16).max).astype(np.uint16)])
+        order = np.lexsort((positions, terms))
+        terms = terms[order]
+        unique_terms, starts = np.unique(terms, return_index=True)
+        np.save(self.path(f"{name}.terms.npy"), unique_terms)
+        np.save(self.path(f"{name}.term_offsets.npy"), np.append(starts, len(terms)).astype(np.int64))
+        np.save(self.path(f"{name}.postings.npy"), positions[order].astype(np.int32))
+        np.save(self.path(f"{name}.term_counts.npy"), counts[order])
+        np.save(self.path(f"{name}.lengths.npy"),
+                np.concatenate([np.asarray(self.base_lengths)[live],
+                                np.asarray([self.delta_lengths[chunk_id] for chunk_id in delta_ids], dtype=np.int32)]))
+
+    def snapshot(self, retrain:bool = False):
+        """
+        Consolidate the snapshot and the segments into a new snapshot and remove the replayed files. The snapshot index
+        is updated incrementally where possible, otherwise (or if retrain is True) it is rebuilt from the raw vectors.
+        """
+        with self.locked():
+            if self.manifest["dim"] is None:
+                return
+            if len(self) == 0:
+                self.clear()
+                return
+            old_snapshot = self.manifest["snapshot"]
+            old_files = [f for f in os.listdir(self.db_dir) if f.startswith(f"{old_snapshot}.")] if old_snapshot else []
+            old_files += [f"{segment}{ext}" for segment in self.manifest["segments"] for ext in (".npz", ".jsonl")]
+            snapshot = f"snapshot-{self.manifest['version'] + 1:010d}"
+            self.write_snapshot_data(snapshot)
+            index = None
+            if not retrain and old_snapshot:
+                # Update a writable copy of the snapshot index with the segments and deletions
+                index = faiss.read_index(self.path(f"{old_snapshot}.faiss"))
+                for ids, vectors in self.live_vectors():
+                    new = ids > self.base_ids[-1] if len(self.base_ids) else np.ones(len(ids), dtype=bool)
+                    if new.any():
+                        index.add_with_ids(vectors[new], ids[new])
+                try:
+                    if self.base_deleted:
+                        index.remove_ids(np.fromiter(self.base_deleted, dtype=np.int64, count=len(self.base_deleted)))
+                except RuntimeError:
+                    # HNSW indexes do not support removing vectors
+                    index = None
+            if index is None:
+                index = build_index(self.manifest["index_type"], np.load(self.path(f"{snapshot}.ids.npy"), mmap_mode='r'),
+                                    np.load(self.path(f"{snapshot}.vectors.npy"), mmap_mode='r'))
+                if retrain:
+                    self.manifest["trained_size"] = len(self)
+            faiss.write_index(index, self.path(f"{snapshot}.faiss"))
+            del index
+            self.manifest.update(snapshot=snapshot, segments=[], deleted=[])
+            self.write_manifest()
+            self.open_snapshot(snapshot)
+            self.delta_index.reset()
+            self.delta_chunks = {}
+            self.delta_terms = {}
+            self.delta_postings = {}
+            self.delta_lengths = {}
+            self.delta_length = 0
+            for f in old_files:
+                os.remove(self.path(f))
+
+    def add(self, texts:list, vectors:list, metadatas:list, maintain:bool = True) -> list:
+        """
+        Append chunks and their vectors to the index and persist them as a new segment. When adding a stream of
+        batches, pass maintain=False and call maintain() after the last batch to snapshot (or rebuild) only once.
+        """
+        if not texts:
+            return []
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.locked():
+            if self.manifest["dim"] is None:
+                self.manifest["dim"] = vectors.shape[1]
+                self.delta_index = build_index("flat", [], vectors[:0])
+            next_id = self.manifest["next_id"]
+            ids = np.arange(next_id, next_id + len(texts), dtype=np.int64)
+            chunks = [{"id": int(chunk_id), "text": text, "metadata": metadata} for chunk_id, text, metadata in zip(ids, texts, metadatas)]
+            segment = f"segment-{next_id:010d}"
+            np.savez(self.path(f"{segment}.npz"), ids=ids, vectors=vectors)
+            with open(self.path(f"{segment}.jsonl"), mode='w') as w:
+                for chunk in chunks:
+                    w.write(json.dumps(chunk) + "\n")
+            self.manifest["next_id"] = next_id + len(texts)
+            self.manifest["segments"].append(segment)
+            self.write_manifest()
+            self.delta_index.add_with_ids(vectors, ids)
+            self.delta_chunks.update((chunk["id"], chunk) for chunk in chunks)
+            for chunk in chunks:
+                self.index_terms(chunk)
+            if maintain:
+                self.maintain()
+            return ids.tolist()
+
+    def maintain(self):
+        """Rebuild the index as another type if the corpus has outgrown it, or snapshot it if there are enough segments"""
+        with self.locked():
+            if self.manifest["dim"] is None:
+                return
+            # Switch to another index type as the corpus grows, and retrain IVF indexes that have outgrown their training
+            index_type = choose_index_type(len(self))
+            if index_type != self.manifest["index_type"] or \
+                    (index_type.startswith("ivf") and len(self) > RETRAIN_GROWTH * self.manifest["trained_size"]):
+                self.manifest["index_type"] = index_type
+                self.snapshot(retrain=True)
+            elif len(self.manifest["segments"]) >= SNAPSHOT_SEGMENTS:
+                self.snapshot()
+
+    def delete_source(self, source:str) -> int:
+        """Delete the chunks (and their vectors) of a source document, identified by its file name"""
+        with self.locked():
+            ids = [chunk_id for chunk_id, chunk in self.delta_chunks.items()
+                   if os.path.basename(chunk["metadata"].get("source", "")) == source]
+            if len(self.base_ids):
+                names = [i for i, name in enumerate(self.base_source_names) if os.path.basename(name) == source]
+                ids += [chunk_id for chunk_id in self.base_ids[np.isin(self.base_sources, names)].tolist() if chunk_id not in self.base_deleted]
+            if ids:
+                self.forget(ids)
+                self.manifest["deleted"].extend(ids)
+                self.write_manifest()
+                if len(self.base_deleted) > COMPACT_DELETED_FRACTION * len(self.base_ids):
+                    self.snapshot()
+            return len(ids)
+
+    def clear(self):
+        """Delete all chunks and vectors"""
+        with self.locked():
+            for f in os.listdir(self.db_dir):
+                if f != LOCK_FILE:
+                    os.remove(self.path(f))
+            version = self.manifest["version"]
+            self.load()
+            self.manifest["version"] = version
+            self.write_manifest()
+
+    def nearest(self, query_vector:list, k:int) -> list:
+        """IDs of the k chunks nearest to a query vector (in the snapshot and the segments), nearest first"""
+        query = np.asarray([query_vector], dtype=np.float32)
+        results = []
+        if self.base_index is not None:
+            # Deleted chunks are excluded inside the search
+            params = self.get_deleted_filters()["params"] if self.base_deleted else None
+            distances, ids = self.base_index.search(query, k, params=params)
+            results += [(d, i) for d, i in zip(distances[0].tolist(), ids[0].tolist()) if i != -1]
+        if self.delta_index is not None and self.delta_index.ntotal:
+            distances, ids = self.delta_index.search(query, k)
+            results += [(d, i) for d, i in zip(distances[0].tolist(), ids[0].tolist()) if i != -1]
+        return [chunk_id for _, chunk_id in sorted(results)[:k]]
+
+    def lexical_search(self, query_text:str, k:int) -> list:
+        """IDs of the k chunks that best match the terms of a query (BM25), best first"""
+        terms = np.fromiter(term_frequencies(query_text), dtype=np.int64)
+        n = len(self.base_ids) + len(self.delta_chunks)
+        if not len(terms) or not n:
+            return []
+        average_length = max((self.base_length + self.delta_length) / n, 1)
+        # Postings of the query terms in the snapshot
+        found = np.searchsorted(self.base_terms, terms)
+        found = found[found < len(self.base_terms)]
+        found = found[np.isin(self.base_terms[found], terms)]
+        postings = {int(self.base_terms[i]): (int(self.base_term_offsets[i]), int(self.base_term_offsets[i + 1])) for i in found}
+        positions, weights, counts = [], [], []
+        results = Counter()
+        for term in terms.tolist():
+            start, end = postings.get(term, (0, 0))
+            delta_postings = self.delta_postings.get(term, {})
+            df = end - start + len(delta_postings)
+            if not df:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            positions.append(np.asarray(self.base_postings[start:end]))
+            counts.append(np.asarray(self.base_term_counts[start:end], dtype=np.float64))
+            weights.append(np.full(end - start, idf))
+            for chunk_id, count in delta_postings.items():
+                length = self.delta_lengths[chunk_id]
+                results[chunk_id] += idf * count * (BM25_K1 + 1) / (count + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+        if positions and sum(map(len, positions)):
+            positions, counts, weights = np.concatenate(positions), np.concatenate(counts), np.concatenate(weights)
+            lengths = np.asarray(self.base_lengths[positions], dtype=np.float64)
+            scores = weights * counts * (BM25_K1 + 1) / (counts + BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length))
+            positions, inverse = np.unique(positions, return_inverse=True)
+            scores = np.bincount(inverse, weights=scores)
+            if self.base_deleted:
+                # Exclude the deleted chunks before ranking
+                live = ~self.get_deleted_filters()["mask"][positions]
+                positions, scores = positions[live], scores[live]
+            # Keep the best matches
+            best = np.argsort(-scores, kind="stable")[:k]
+            results.update(dict(zip(self.base_ids[positions[best]].tolist(), scores[best].tolist())))
+        return [chunk_id for chunk_id, _ in results.most_common(k)]
+
+    def search(self, query_vector:list, k:int = 3, query_text:str = None) -> list:
+        """
+        Find the k chunks most relevant to a query, as LangChain documents: the chunks nearest to the query vector or,
+        if the query text is provided, the best of the nearest chunks and the chunks that best match its terms (BM25),
+        combined with reciprocal rank fusion.
+        """
+        with self.lock:
+            self.reload_if_changed()
+            if query_text and HYBRID_SEARCH:
+                candidates = max(k, HYBRID_SEARCH_CANDIDATES)
+                scores = Counter()
+                for ranking in (self.nearest(query_vector, candidates), self.lexical_search(query_text, candidates)):
+                    for rank, chunk_id in enumerate(ranking):
+                        scores[chunk_id] += 1 / (RRF_K + rank + 1)
+                ids = [chunk_id for chunk_id, _ in scores.most_common(k)]
+            else:
+                ids = self.nearest(query_vector, k)
+            chunks = [self.chunk(chunk_id) for chunk_id in ids]
+            return [Document(page_content=chunk["text"], metadata=chunk["metadata"]) for chunk in chunks if chunk is not None]
+
+
+# Document indexes are resident and shared by all sessions
+document_indexes = {}
+document_indexes_lock = threading.Lock()
+
+
+def get_document_index(db_dir:str) -> DocumentIndex:
+    """Get the resident document index for a directory, loading it on first use"""
+    with document_indexes_lock:
+        if str(db_dir) not in document_indexes:
+            document_indexes[str(db_dir)] = DocumentIndex(str(db_dir))
+        return document_indexes[str(db_dir)]
+
+
+class SentenceIndex:
+    """
+    Normalized embeddings of the sentences of a text in a contiguous matrix, searched exactly by cosine similarity
+    with a single matrix product for a batch of queries.
+    """
+
+    def __init__(self, sentences:list, vectors:list):
+        self.sentences = sentences
+        self.matrix = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(sentences), -1)
+        self.matrix /= np.maximum(np.linalg.norm(self.matrix, axis=1, keepdims=True), 1e-12)
+
+    def search(self, query_vectors:list, k:int = 1) -> list:
+        """Find the k sentences most similar to each query vector, as lists of (sentence, similarity), most similar first"""
+        queries = np.asarray(query_vectors, dtype=np.float32).reshape(-1, self.matrix.shape[1])
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        similarities = queries @ self.matrix.T
+        k = min(k, len(self.sentences))
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(similarities, top):
+            best = candidates[np.argsort(-row[candidates], kind="stable")]
+            results.append([(self.sentences[i], float(row[i])) for i in best])
+        return results
+
+
+# Sentence indexes are resident and shared by all sessions, keyed by the hash of the sentences and the embedding model
+sentence_indexes = OrderedDict()
+sentence_indexes_lock = threading.Lock()
+
+
+def get_sentence_index(sentences:list, embeddings) -> SentenceIndex:
+    """
+    Get the sentence index of a list of sentences, embedding them on first use. Embeddings are expected to be cached
+    by text (see utils.CachedEmbeddings), so only new or edited sentences of an edited text are embedded again.
+    """
+    key = hashlib.sha256("\0".join([embeddings.model_id] + sentences).encode()).hexdigest()
+    with sentence_indexes_lock:
+        if key in sentence_indexes:
+            sentence_indexes.move_to_end(key)
+            return sentence_indexes[key]
+    index = SentenceIndex(sentences, embeddings.embed_documents(sentences))
+    with sentence_indexes_lock:
+        sentence_indexes[key] = index
+        while len(sentence_indexes) > SENTENCE_INDEX_CACHE_SIZE:
+            sentence_indexes.popitem(last=False)
+    return index